@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-event cost of reading config values: Config.__getitem__ (environment lookup followed by a
+dotted-path walk of the YAML tree) against the resolved Settings snapshot.
+
+Usage: python -m benchmarks.config_access [-c config.yaml] [-n iterations]
+"""
+
+import argparse
+import timeit
+
+from sappservice.config import Config
+
+# the config reads one chat event used to make across Matrix.handle_event, say_from_matrix
+# and matrix_user_joined before the settings snapshot
+EVENT_KEYS = ("homeserver.domain", "appservice.namespace",
+              "appservice.namespace",
+              "homeserver.domain", "appservice.namespace", "appservice.bot_username",
+              "appservice.bot_username", "homeserver.domain")
+
+
+def per_event_getitem(config: Config) -> None:
+    for key in EVENT_KEYS:
+        config[key]
+
+
+def per_event_settings(config: Config) -> None:
+    settings = config.settings
+    settings.homeserver_domain
+    settings.namespace
+    settings.namespace
+    settings.homeserver_domain
+    settings.namespace
+    settings.bot_username
+    settings.bot_username
+    settings.homeserver_domain
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.sample.yaml")
+    parser.add_argument("-n", "--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    config = Config(args.config, "", "")
+    config.load()
+
+    for name, fn in (("Config.__getitem__", per_event_getitem), ("Settings", per_event_settings)):
+        best = min(timeit.repeat(lambda: fn(config), number=args.iterations, repeat=5))
+        print(f"{name:>20}: {best / args.iterations * 1e9:8.0f} ns/event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process stand-in for the parts of the Matrix client-server API the bridge uses, and a way to
+push appservice transactions at the bridge.
+"""
+
+import itertools
+import json
+import re
+import time
+
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+
+from aiohttp import web
+
+from benchmarks.util import Observed, parse_marker
+
+ROUTES = [
+    ("GET", r"/account/whoami$", "whoami"),
+    ("POST", r"/register$", "register"),
+    ("POST", r"/join/(?P<room>[^/]+)$", "join"),
+    ("POST", r"/rooms/(?P<room>[^/]+)/join$", "join"),
+    ("POST", r"/rooms/(?P<room>[^/]+)/leave$", "leave"),
+    ("GET", r"/rooms/(?P<room>[^/]+)/joined_members$", "joined_members"),
+    ("PUT", r"/rooms/(?P<room>[^/]+)/send/(?P<type>[^/]+)/[^/]+$", "send"),
+    ("POST", r"/rooms/(?P<room>[^/]+)/receipt/.*$", "receipt"),
+    ("GET", r"/profile/(?P<user>[^/]+)/displayname$", "get_displayname"),
+    ("GET", r"/profile/(?P<user>[^/]+)$", "get_profile"),
+    ("PUT", r"/profile/.*$", "set_profile"),
+    ("PUT", r"/presence/.*$", "presence"),
+]
+ROUTES = [(method, re.compile(pattern), name) for method, pattern, name in ROUTES]
+
+
+class FakeHomeserver(Observed):
+    """
+    Answers the client-server API calls of the bridge from memory and records them: request
+    counts per endpoint, room membership, and the arrival time of every benchmark message.
+    """
+
+    def __init__(self, domain: str, bot_mxid: str, rooms: Dict[str, List[str]]) -> None:
+        super().__init__()
+        self.domain = domain
+        self.bot_mxid = bot_mxid
+        self.members: Dict[str, Set[str]] = {room_id: set(members) for room_id, members in rooms.items()}
+
+        self.requests: Counter = Counter()
+        self.joins = 0
+        self.leaves = 0
+        self.messages: Dict[int, float] = dict()
+
+        self.appservice_url: Optional[str] = None
+        self.hs_token: Optional[str] = None
+        self._txn_ids = itertools.count()
+        self._event_ids = itertools.count()
+
+        self.app = web.Application()
+        self.app.router.add_route("*", "/_matrix/client/{version}/{path:.*}", self.handle)
+        self.runner: Optional[web.AppRunner] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.session = aiohttp.ClientSession()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        path = f"/{request.match_info['path']}"
+        user_id = request.query.get("user_id", self.bot_mxid)
+        for method, pattern, name in ROUTES:
+            if method != request.method:
+                continue
+            match = pattern.match(path)
+            if match:
+                self.requests[name] += 1
+                response = await getattr(self, f"on_{name}")(request, user_id, **match.groupdict())
+                self.notify()
+                return web.json_response(response)
+
+        self.requests["other"] += 1
+        return web.json_response({})
+
+    async def on_whoami(self, request: web.Request, user_id: str) -> Dict:
+        return {"user_id": user_id}
+
+    async def on_register(self, request: web.Request, user_id: str) -> Dict:
+        body = await request.json()
+        return {"user_id": f"@{body.get('username')}:{self.domain}"}
+
+    async def on_join(self, request: web.Request, user_id: str, room: str) -> Dict:
+        self.members.setdefault(room, set()).add(user_id)
+        self.joins += 1
+        return {"room_id": room}
+
+    async def on_leave(self, request: web.Request, user_id: str, room: str) -> Dict:
+        self.members.get(room, set()).discard(user_id)
+        self.leaves += 1
+        return {}
+
+    async def on_joined_members(self, request: web.Request, user_id: str, room: str) -> Dict:
+        return {"joined": {member: {"display_name": member[1:].split(":")[0], "avatar_url": None}
+                           for member in self.members.get(room, ())}}
+
+    async def on_send(self, request: web.Request, user_id: str, room: str, type: str) -> Dict:
+        content = await request.json()
+        seq = parse_marker(content.get("body", ""))
+        if seq >= 0:
+            self.messages[seq] = time.monotonic()
+        return {"event_id": f"$fake{next(self._event_ids)}"}
+
+    async def on_receipt(self, request: web.Request, user_id: str, room: str) -> Dict:
+        return {}
+
+    async def on_get_displayname(self, request: web.Request, user_id: str, user: str) -> Dict:
+        return {"displayname": user[1:].split(":")[0]}
+
+    async def on_get_profile(self, request: web.Request, user_id: str, user: str) -> Dict:
+        return {"displayname": user[1:].split(":")[0]}
+
+    async def on_set_profile(self, request: web.Request, user_id: str) -> Dict:
+        return {}
+
+    async def on_presence(self, request: web.Request, user_id: str) -> Dict:
+        return {}
+
+    async def push(self, events: List[Dict]) -> None:
+        """
+        Deliver a transaction of events to the bridge, like the homeserver does.
+        """
+        url = f"{self.appservice_url}/transactions/bench{next(self._txn_ids)}"
+        async with self.session.put(url, params={"access_token": self.hs_token},
+                                    data=json.dumps({"events": events})) as response:
+            response.raise_for_status()
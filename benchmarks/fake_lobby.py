@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stand-in lobby server speaking enough of the uberserver protocol for the bridge: the TASSERVER
+greeting, LOGIN, JOIN with its CLIENTS reply and PING, plus the bridge commands
+(BRIDGECLIENTFROM, JOINFROM, SAYFROM, LEAVEFROM), which are recorded.
+"""
+
+import asyncio
+import time
+
+from collections import Counter
+from typing import Dict, List, Optional
+
+from benchmarks.util import Observed, parse_marker
+
+
+class FakeLobbyProtocol(asyncio.Protocol):
+    def __init__(self, server: "FakeLobby") -> None:
+        self.server = server
+        self.transport: Optional[asyncio.Transport] = None
+        self.username: Optional[str] = None
+        self._buffer = b""
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        self.server.connections.append(self)
+        self.send("TASSERVER 0.38-bench * 8201 0")
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self in self.server.connections:
+            self.server.connections.remove(self)
+        self.server.notify()
+
+    def send(self, line: str) -> None:
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(f"{line}\n".encode())
+
+    def data_received(self, data: bytes) -> None:
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.decode(errors="replace").rstrip("\r")
+            if line.startswith("#"):
+                # optional message id prefix
+                line = line.split(" ", 1)[1] if " " in line else ""
+            if line:
+                self.server.received(self, line)
+
+
+class FakeLobby(Observed):
+    """
+    ``channels`` maps each channel to the lobby users listed in its CLIENTS reply.
+    """
+
+    def __init__(self, channels: Dict[str, List[str]]) -> None:
+        super().__init__()
+        self.channels = channels
+        self.connections: List[FakeLobbyProtocol] = list()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+        self.commands: Counter = Counter()
+        self.said: Dict[int, float] = dict()
+        self.logins = 0
+        self.accepted_at: List[float] = list()
+        self.joined_at: List[float] = list()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(lambda: FakeLobbyProtocol(self), host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def broadcast(self, line: str) -> None:
+        for connection in self.connections:
+            connection.send(line)
+
+    def drop(self) -> None:
+        """
+        Close every client connection, as a lobby restart would.
+        """
+        for connection in list(self.connections):
+            connection.transport.close()
+
+    def received(self, connection: FakeLobbyProtocol, line: str) -> None:
+        command, _, args = line.partition(" ")
+        self.commands[command] += 1
+
+        if command == "LOGIN":
+            connection.username = args.split(" ", 1)[0]
+            self.logins += 1
+            self.accepted_at.append(time.monotonic())
+            connection.send(f"ACCEPTED {connection.username}")
+            connection.send("MOTD benchmark lobby")
+            connection.send("LOGININFOEND")
+        elif command == "JOIN":
+            channel = args.split(" ", 1)[0].lstrip("#")
+            self.joined_at.append(time.monotonic())
+            connection.send(f"JOIN {channel}")
+            users = [connection.username] + self.channels.get(channel, [])
+            connection.send(f"CLIENTS {channel} {' '.join(users)}")
+        elif command == "PING":
+            connection.send("PONG")
+        elif command == "SAYFROM":
+            seq = parse_marker(args)
+            if seq >= 0:
+                self.said[seq] = time.monotonic()
+        elif command == "EXIT":
+            connection.transport.close()
+
+        self.notify()
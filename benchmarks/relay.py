@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end relay benchmark. Runs the bridge in-process against a fake homeserver and a fake
+lobby server on localhost and reports throughput, relay latency and memory per scenario:
+
+    startup_sync    lobby login accepted -> every member of a big room bridged (JOINFROM)
+    chat_flood      lobby SAID messages -> messages sent to the matrix room
+    matrix_flood    matrix messages pushed in transactions -> SAYFROM at the lobby
+    join_storm      one big CLIENTS burst -> puppet joins at the homeserver
+    reconnect_storm the lobby drops the bridge repeatedly -> bridge logged in and joined again
+
+The bridge keeps its state in PostgreSQL, so a database is still needed; use a throwaway one,
+as the bridge tables are created and left there.
+
+Usage: python -m benchmarks.relay [-d postgres://localhost/sappservice_bench] [-n 2000]
+                                  [-m 1000] [-s chat_flood -s matrix_flood ...]
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List
+
+from ruamel.yaml import YAML
+
+from sappservice.sappservice import sappservice
+
+from benchmarks.fake_homeserver import FakeHomeserver
+from benchmarks.fake_lobby import FakeLobby
+from benchmarks.util import BENCH_MARKER, latencies, percentile, rss_bytes
+
+DOMAIN = "bench.local"
+CHANNEL = "bench"
+ROOM_ID = f"!bench:{DOMAIN}"
+BOT_MXID = f"@appservice:{DOMAIN}"
+TOKEN = "bench"
+
+
+class Result(object):
+    def __init__(self, name: str, count: int, expected: int, duration: float,
+                 latency: List[float], rss_before: int, rss_after: int, **extra) -> None:
+        self.name = name
+        self.count = count
+        self.expected = expected
+        self.duration = duration
+        self.latency = latency
+        self.rss_before = rss_before
+        self.rss_after = rss_after
+        self.extra = extra
+
+    @property
+    def rate(self) -> float:
+        return self.count / self.duration if self.duration else 0.0
+
+    def as_dict(self) -> Dict:
+        return {"scenario": self.name, "count": self.count, "expected": self.expected,
+                "seconds": self.duration, "per_second": self.rate,
+                "p50": percentile(self.latency, 50), "p99": percentile(self.latency, 99),
+                "rss": self.rss_after, "rss_delta": self.rss_after - self.rss_before, **self.extra}
+
+    def row(self) -> str:
+        complete = "" if self.count >= self.expected else f"  INCOMPLETE {self.count}/{self.expected}"
+        extra = "".join(f"  {key}={value}" for key, value in self.extra.items())
+        return (f"{self.name:>16} {self.count:>8} {self.duration:>9.3f} {self.rate:>10.1f} "
+                f"{percentile(self.latency, 50) * 1000:>8.2f} {percentile(self.latency, 99) * 1000:>8.2f} "
+                f"{self.rss_after / 2 ** 20:>8.1f} {(self.rss_after - self.rss_before) / 2 ** 20:>+8.1f}"
+                f"{complete}{extra}")
+
+
+HEADER = (f"{'scenario':>16} {'count':>8} {'seconds':>9} {'per sec':>10} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'rss MiB':>8} {'delta':>8}")
+
+
+class Bench(object):
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.domain = DOMAIN
+        self.members = [f"@member{i}:remote.example" for i in range(args.members)]
+        self.homeserver = FakeHomeserver(DOMAIN, BOT_MXID, {ROOM_ID: [BOT_MXID] + self.members})
+        self.lobby = FakeLobby({CHANNEL: [f"lobbyuser{i}" for i in range(args.lobby_users)]})
+        self._seq = 0
+
+    def next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def bridge_rooms(self) -> Dict[str, Dict]:
+        return {CHANNEL: {"room_id": ROOM_ID, "enabled": True}}
+
+    def write_config(self, homeserver_port: int, lobby_port: int, appservice_port: int) -> str:
+        yaml = YAML()
+        with open(self.args.config) as file:
+            config = yaml.load(file)
+
+        config["homeserver"].update({"address": f"http://127.0.0.1:{homeserver_port}", "domain": self.domain,
+                                     "verify_ssl": 0})
+        config["spring"].update({"address": "127.0.0.1", "port": lobby_port, "ssl": False})
+        config["appservice"].update({"address": f"http://127.0.0.1:{appservice_port}",
+                                     "hostname": "127.0.0.1", "port": appservice_port,
+                                     "as_token": TOKEN, "hs_token": TOKEN,
+                                     "database": self.args.database})
+        config["bridge"]["rooms"] = self.bridge_rooms()
+        config["bridge"].setdefault("reconcile", {})["lobby_keeps_state"] = self.args.lobby_keeps_state
+        config.setdefault("metrics", {})["enabled"] = False
+        config.setdefault("monitor", {})["enabled"] = False
+        config.setdefault("recorder", {})["path"] = ""
+        config["logging"] = {"version": 1,
+                             "handlers": {"console": {"class": "logging.StreamHandler"}},
+                             "root": {"level": self.args.log_level, "handlers": ["console"]}}
+
+        file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+        with file:
+            yaml.dump(config, file)
+        return file.name
+
+    async def start(self) -> Result:
+        """
+        Start the fakes and the bridge. Measures startup_sync: from the first accepted login to
+        every room member bridged to the lobby.
+        """
+        homeserver_port = await self.homeserver.start()
+        lobby_port = await self.lobby.start()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            appservice_port = sock.getsockname()[1]
+
+        self.homeserver.appservice_url = f"http://127.0.0.1:{appservice_port}"
+        self.homeserver.hs_token = TOKEN
+
+        rss_before = rss_bytes()
+        started = time.monotonic()
+        await sappservice(self.write_config(homeserver_port, lobby_port, appservice_port),
+                          asyncio.get_event_loop())
+        startup = time.monotonic() - started
+
+        expected = len(self.members)
+        await self.lobby.wait_until(lambda: self.lobby.commands["JOINFROM"] >= expected, self.args.timeout)
+        done = time.monotonic()
+        accepted = self.lobby.accepted_at[0] if self.lobby.accepted_at else started
+        return Result("startup_sync", self.lobby.commands["JOINFROM"], expected, done - accepted, [],
+                      rss_before, rss_bytes(), startup=round(startup, 3),
+                      hs_requests=sum(self.homeserver.requests.values()))
+
+    async def chat_flood(self) -> Result:
+        n = self.args.messages
+        sent: Dict[int, float] = dict()
+        received_before = len(self.homeserver.messages)
+        rss_before = rss_bytes()
+        started = time.monotonic()
+        for i in range(n):
+            seq = self.next_seq()
+            sent[seq] = time.monotonic()
+            self.lobby.broadcast(f"SAID {CHANNEL} lobbyuser{i % 50} {BENCH_MARKER}{seq}")
+            if i % 100 == 99:
+                # let the transport flush like a real socket would
+                await asyncio.sleep(0)
+
+        await self.homeserver.wait_until(lambda: len(self.homeserver.messages) - received_before >= n,
+                                         self.args.timeout)
+        received = latencies(sent, self.homeserver.messages)
+        return Result("chat_flood", len(received), n, time.monotonic() - started, received,
+                      rss_before, rss_bytes())
+
+    async def matrix_flood(self) -> Result:
+        n = self.args.messages
+        batch = self.args.transaction_size
+        sent: Dict[int, float] = dict()
+        received_before = len(self.lobby.said)
+        rss_before = rss_bytes()
+        started = time.monotonic()
+        for start in range(0, n, batch):
+            events = list()
+            now = time.monotonic()
+            for i in range(start, min(n, start + batch)):
+                seq = self.next_seq()
+                sent[seq] = now
+                events.append({"type": "m.room.message", "room_id": ROOM_ID,
+                               "sender": self.members[i % len(self.members)],
+                               "event_id": f"$bench{seq}", "origin_server_ts": int(time.time() * 1000),
+                               "content": {"msgtype": "m.text", "body": f"{BENCH_MARKER}{seq}"},
+                               "unsigned": {}})
+            await self.homeserver.push(events)
+
+        await self.lobby.wait_until(lambda: len(self.lobby.said) - received_before >= n, self.args.timeout)
+        received = latencies(sent, self.lobby.said)
+        return Result("matrix_flood", len(received), n, time.monotonic() - started, received,
+                      rss_before, rss_bytes())
+
+    async def join_storm(self) -> Result:
+        n = self.args.joins
+        users = [f"storm{self.next_seq()}" for _ in range(n)]
+        joins_before = self.homeserver.joins
+        rss_before = rss_bytes()
+        started = time.monotonic()
+        for start in range(0, n, 200):
+            self.lobby.broadcast(f"CLIENTS {CHANNEL} {' '.join(users[start:start + 200])}")
+
+        await self.homeserver.wait_until(lambda: self.homeserver.joins - joins_before >= n, self.args.timeout)
+        duration = time.monotonic() - started
+        return Result("join_storm", self.homeserver.joins - joins_before, n, duration, [],
+                      rss_before, rss_bytes())
+
+    async def reconnect_storm(self) -> Result:
+        n = self.args.reconnects
+        requests_before = sum(self.homeserver.requests.values())
+        recover: List[float] = list()
+        rss_before = rss_bytes()
+        started = time.monotonic()
+        for _ in range(n):
+            joins = len(self.lobby.joined_at)
+            dropped = time.monotonic()
+            self.lobby.drop()
+            if not await self.lobby.wait_until(lambda: len(self.lobby.joined_at) > joins, self.args.timeout):
+                break
+            recover.append(self.lobby.joined_at[-1] - dropped)
+
+        return Result("reconnect_storm", len(recover), n, time.monotonic() - started, recover,
+                      rss_before, rss_bytes(),
+                      hs_requests=sum(self.homeserver.requests.values()) - requests_before)
+
+
+SCENARIOS: Dict[str, Callable[[Bench], "asyncio.Future"]] = {
+    "chat_flood": Bench.chat_flood,
+    "matrix_flood": Bench.matrix_flood,
+    "join_storm": Bench.join_storm,
+    "reconnect_storm": Bench.reconnect_storm,
+}
+
+
+async def run(args: argparse.Namespace) -> List[Result]:
+    bench = Bench(args)
+    results = [await bench.start()]
+    for name in args.scenarios or list(SCENARIOS):
+        results.append(await SCENARIOS[name](bench))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", default="config.sample.yaml",
+                        help="base config, the addresses, rooms and logging are overridden")
+    parser.add_argument("-d", "--database", default="postgres://localhost/sappservice_bench")
+    parser.add_argument("-s", "--scenario", dest="scenarios", action="append", choices=list(SCENARIOS))
+    parser.add_argument("-n", "--messages", type=int, default=2000)
+    parser.add_argument("-m", "--members", type=int, default=1000, help="matrix members of the room")
+    parser.add_argument("--lobby-users", type=int, default=100, help="lobby users listed in CLIENTS")
+    parser.add_argument("--joins", type=int, default=1000)
+    parser.add_argument("--reconnects", type=int, default=10)
+    parser.add_argument("--transaction-size", type=int, default=50)
+    parser.add_argument("--lobby-keeps-state", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+
+    if args.json:
+        json.dump([result.as_dict() for result in results], sys.stdout, indent=2)
+        print()
+    else:
+        print(HEADER)
+        for result in results:
+            print(result.row())
+
+    sys.exit(0 if all(result.count >= result.expected for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
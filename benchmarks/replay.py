@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Replay a traffic capture made with the recorder (``recorder.path``) against a bridge running
+in-process on the fake homeserver and fake lobby server.
+
+The bridge uses the rooms of the given config, so use the config of the recorded instance
+(addresses, tokens and logging are overridden). Lobby lines are sent by the fake lobby and
+matrix events are pushed as appservice transactions, at the recorded pace divided by
+``--speed``; ``--speed 0`` replays as fast as the bridge accepts the traffic.
+
+Usage: python -m benchmarks.replay capture.jsonl.gz [-c config.yaml] [-d postgres://...] [--speed 1]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from typing import Dict, List
+
+from ruamel.yaml import YAML
+
+from sappservice.recorder import LOBBY, MATRIX, START, read_capture
+
+from benchmarks.fake_homeserver import FakeHomeserver
+from benchmarks.fake_lobby import FakeLobby
+from benchmarks.relay import BOT_MXID, HEADER, Bench, Result
+from benchmarks.util import rss_bytes
+
+# lines the fake lobby sends itself while the bridge logs in, or answers to the bridge
+HANDSHAKE = {"TASSERVER", "ACCEPTED", "DENIED", "MOTD", "LOGININFOEND", "AGREEMENT", "AGREEMENTEND",
+             "PONG"}
+
+
+class ReplayBench(Bench):
+    def __init__(self, args: argparse.Namespace, domain: str, rooms: Dict[str, Dict]) -> None:
+        self.args = args
+        self.domain = domain
+        self.rooms = rooms
+        self.members = list()
+        bot_mxid = f"{BOT_MXID.split(':')[0]}:{domain}"
+        self.homeserver = FakeHomeserver(domain, bot_mxid, {room["room_id"]: [bot_mxid] for room in rooms.values()})
+        self.lobby = FakeLobby({channel: [] for channel in rooms})
+        self._seq = 0
+
+    def bridge_rooms(self) -> Dict[str, Dict]:
+        return self.rooms
+
+    async def settle(self, quiet: float = 1.0) -> None:
+        """
+        Wait until neither fake has seen any traffic for ``quiet`` seconds.
+        """
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            before = (sum(self.homeserver.requests.values()), sum(self.lobby.commands.values()))
+            await asyncio.sleep(quiet)
+            if before == (sum(self.homeserver.requests.values()), sum(self.lobby.commands.values())):
+                return
+
+    async def replay(self, path: str, speed: float) -> Result:
+        sends_before = self.homeserver.requests["send"]
+        says_before = self.lobby.commands["SAYFROM"]
+        rss_before = rss_bytes()
+
+        records = total = 0
+        max_lag = 0.0
+        events: List[Dict] = list()
+        shift = last = 0.0
+        started = time.monotonic()
+        for offset, kind, data in read_capture(path):
+            if kind == START:
+                # a later run appended to the same file, continue its offsets after this one's
+                shift = last
+                continue
+            total += 1
+            last = shift + offset
+
+            if speed:
+                delay = last / speed - (time.monotonic() - started)
+                if delay > 0:
+                    if events:
+                        await self.homeserver.push(events)
+                        events = list()
+                    await asyncio.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+
+            if kind == LOBBY:
+                if data.split(" ", 1)[0] in HANDSHAKE:
+                    continue
+                self.lobby.broadcast(data)
+                if records % 100 == 0:
+                    await asyncio.sleep(0)
+            elif kind == MATRIX:
+                events.append(data)
+                if len(events) >= self.args.transaction_size:
+                    await self.homeserver.push(events)
+                    events = list()
+            records += 1
+
+        if events:
+            await self.homeserver.push(events)
+        replayed = time.monotonic() - started
+        await self.settle()
+
+        return Result("replay", records, records, replayed, [], rss_before, rss_bytes(),
+                      speed=speed or "max", max_lag=round(max_lag, 3),
+                      drained=round(time.monotonic() - started - replayed, 3),
+                      skipped=total - records,
+                      hs_sends=self.homeserver.requests["send"] - sends_before,
+                      lobby_says=self.lobby.commands["SAYFROM"] - says_before)
+
+
+async def run(args: argparse.Namespace) -> List[Result]:
+    with open(args.config) as file:
+        config = YAML().load(file)
+
+    bench = ReplayBench(args, str(config["homeserver"]["domain"]), dict(config["bridge"]["rooms"] or {}))
+    results = [await bench.start()]
+    for _ in range(args.repeat):
+        results.append(await bench.replay(args.capture, args.speed))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture")
+    parser.add_argument("-c", "--config", default="config.yaml", help="config of the recorded instance")
+    parser.add_argument("-d", "--database", default="postgres://localhost/sappservice_bench")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for max")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--transaction-size", type=int, default=50)
+    parser.add_argument("--lobby-keeps-state", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+
+    if args.json:
+        json.dump([result.as_dict() for result in results], sys.stdout, indent=2)
+        print()
+    else:
+        print(HEADER)
+        for result in results:
+            print(result.row())
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
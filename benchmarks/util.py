@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import resource
+import time
+
+from typing import Callable, Dict, List
+
+BENCH_MARKER = "bench-"
+
+
+class Observed(object):
+    """
+    Base for the fake servers: lets the benchmark wait until a condition on the recorded traffic
+    holds.
+    """
+
+    def __init__(self) -> None:
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        self._changed.set()
+
+    async def wait_until(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+
+def parse_marker(text: str) -> int:
+    """
+    The sequence number of a benchmark message, or -1 for other text.
+    """
+    index = text.find(BENCH_MARKER)
+    if index < 0:
+        return -1
+    digits = text[index + len(BENCH_MARKER):].split(" ", 1)[0]
+    return int(digits) if digits.isdigit() else -1
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def latencies(sent: Dict[int, float], received: Dict[int, float]) -> List[float]:
+    return [received[seq] - sent[seq] for seq in sent if seq in received]
+
+
+def rss_bytes() -> int:
+    """
+    Current resident set size (Linux), 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
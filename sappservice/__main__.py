@@ -24,9 +24,12 @@ import asyncio
 import sys
 
 from sappservice.sappservice import sappservice
+from sappservice.sharding import configured_shards, supervise
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-c', '--config')
+parser.add_argument('-s', '--shards', type=int, help="number of worker processes (sharding.shards)")
+parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
 args = parser.parse_args()
 
 config_filename = args.config
@@ -37,6 +40,12 @@ Ussage: sappservice -c config.yaml
 """)
     sys.exit(1)
 
+shards = args.shards or configured_shards(config_filename)
+
 loop = asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
-loop.run_until_complete(sappservice(config_filename=config_filename, loop=loop))
-loop.run_forever()
+if args.shard is None and shards > 1:
+    loop.run_until_complete(supervise(config_filename=config_filename, shards=shards, loop=loop))
+else:
+    loop.run_until_complete(sappservice(config_filename=config_filename, loop=loop,
+                                        shard=args.shard, shards=shards))
+    loop.run_forever()
@@ -15,7 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, NamedTuple
 
 from mautrix.bridge.config import (BaseBridgeConfig, ConfigUpdateHelper)
 
@@ -26,14 +26,60 @@ yaml.indent(4)
 yaml.width = 200
 
 
+class Settings(NamedTuple):
+    """
+    Config values read on the event hot paths, resolved once with environment overrides applied.
+    """
+
+    homeserver_domain: str
+
+    namespace: str
+    bot_username: str
+    bot_mxid: str
+
+
 class Config(BaseBridgeConfig):
+    settings: Settings
+
+    def __init__(self, path: str, registration_path: str, base_path: str) -> None:
+        super().__init__(path, registration_path, base_path)
+        # values set at runtime that must win over the environment, e.g. per-shard settings
+        self._overrides: Dict[str, Any] = dict()
 
     def __getitem__(self, key: str) -> Any:
+        try:
+            return self._overrides[key]
+        except KeyError:
+            pass
         try:
             return os.environ[f"MATRIX_SPRING_{key.replace('.', '_').upper()}"]
         except KeyError:
             return super().__getitem__(key)
 
+    def override(self, key: str, value: Any) -> None:
+        self._overrides[key] = value
+
+    def get_or(self, key: str, default: Any) -> Any:
+        """
+        ``self[key]``, or ``default`` if it is unset. Unlike ``self[key] or default`` this keeps
+        explicit zeros, for options where 0 means "none" or "unlimited".
+        """
+        value = self[key]
+        return default if value is None else value
+
+    def load(self) -> None:
+        super().load()
+        self.settings = self.resolve_settings()
+
+    def resolve_settings(self) -> Settings:
+        domain = str(self["homeserver.domain"])
+        bot_username = str(self["appservice.bot_username"])
+
+        return Settings(homeserver_domain=domain,
+                        namespace=str(self["appservice.namespace"]),
+                        bot_username=bot_username,
+                        bot_mxid=f"@{bot_username}:{domain}")
+
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         super().do_update(helper)
 
@@ -43,6 +89,11 @@ class Config(BaseBridgeConfig):
         copy("homeserver.domain")
         copy("homeserver.verify_ssl")
         copy("homeserver.asmux")
+        copy("homeserver.http.limit")
+        copy("homeserver.http.limit_per_host")
+        copy("homeserver.http.keepalive_timeout")
+        copy("homeserver.http.dns_cache_ttl")
+        copy("homeserver.http.unix_socket")
 
         if "appservice.protocol" in self and "appservice.address" not in self:
             protocol, hostname, port = (self["appservice.protocol"], self["appservice.hostname"],
@@ -80,13 +131,63 @@ class Config(BaseBridgeConfig):
 
         copy("spring.client_name")
         copy("spring.client_flags")
+        copy("spring.connect_timeout")
+        copy("spring.backoff.first")
+        copy("spring.backoff.initial")
+        copy("spring.backoff.max")
         copy("spring.comunity_id")
 
         copy("bridge.command_prefix")
         copy("bridge.username_template")
         copy("bridge.alias_template")
         copy("bridge.rooms")
-
+        copy("bridge.sync_concurrency")
+        copy("bridge.profile_cache.size")
+        copy("bridge.profile_cache.ttl")
+        copy("bridge.profile_cache.negative_ttl")
+        copy("bridge.outbound.workers")
+        copy("bridge.outbound.max_queue_size")
+        copy("bridge.outbound.overflow")
+        copy("bridge.receipt_delay")
+        copy("bridge.rate_limit.rate")
+        copy("bridge.rate_limit.burst")
+        copy("bridge.rate_limit.user_rate")
+        copy("bridge.rate_limit.user_burst")
+        copy("bridge.rate_limit.max_retries")
+        copy("bridge.membership.batch_window")
+        copy("bridge.membership.concurrency")
+        copy("bridge.lanes.concurrency")
+        copy("bridge.lanes.chat_reserve")
+        copy("bridge.puppet_cache_size")
+        copy("bridge.lobby_outbox.max_size")
+        copy("bridge.lobby_outbox.max_age")
+        copy("bridge.reconcile.lobby_keeps_state")
+        copy("bridge.identity.prefixes")
+        copy("bridge.identity.ignore")
+        copy("bridge.identity.cache_size")
+
+        copy("metrics.enabled")
+        copy("metrics.path")
+
+        copy("monitor.enabled")
+        copy("monitor.interval")
+        copy("monitor.lag_warning")
+        copy("monitor.slow_callback")
+        copy("monitor.asyncio_debug")
+        copy("monitor.debug_endpoints")
+
+        copy("log_queue")
+        copy("startup.health_path")
+        copy("recorder.path")
+        copy("recorder.flush_interval")
+        copy("recorder.lobby")
+        copy("recorder.matrix")
+        copy("sharding.shards")
+        copy("sharding.worker_base_port")
+        copy("sharding.lobby_accounts")
+        copy("ha.enabled")
+        copy("ha.interval")
+        copy("ha.lock_key")
         copy("logging")
 
     @property
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import random
+import ssl
+
+from typing import Any, Callable, Optional, Tuple
+
+from sappservice.metrics import LOBBY_CONNECT_FAILURES, LOBBY_STATE, LOBBY_STATE_CHANGES
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+AUTHENTICATING = "authenticating"
+READY = "ready"
+BACKOFF = "backoff"
+
+STATES = (DISCONNECTED, CONNECTING, AUTHENTICATING, READY, BACKOFF)
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter.
+
+    The first retry waits about ``first`` seconds so a short blip recovers almost immediately.
+    After that the delay doubles from ``initial`` up to ``maximum``, and each delay is randomized
+    to between half and all of its value so many clients don't retry in lockstep.
+    """
+
+    def __init__(self, first: float = 0.5, initial: float = 2, maximum: float = 300) -> None:
+        self.first = first
+        self.initial = initial
+        self.maximum = maximum
+        self.attempt = 0
+
+    def reset(self) -> None:
+        self.attempt = 0
+
+    def next(self) -> float:
+        if self.attempt == 0:
+            delay = self.first
+        else:
+            delay = min(self.maximum, self.initial * 2 ** (self.attempt - 1))
+        self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+
+class LobbyConnection(object):
+    """
+    Opens the TCP/TLS connection to the lobby server and tracks its state.
+
+    ``open`` retries until a connection is made: refused and reset connections, DNS and TLS
+    errors, and attempts exceeding ``timeout`` seconds all move to ``backoff``. Once connected
+    the state is ``authenticating`` until :meth:`ready` is called for the accepted login; the
+    backoff is only reset then, so a server that takes connections but fails logins still gets
+    backed off.
+    """
+
+    log: logging.Logger
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol_factory: Callable[[], asyncio.Protocol],
+                 host: str, port: int, use_ssl: Any = False, timeout: float = 30,
+                 backoff: Optional[Backoff] = None) -> None:
+        self.log = logging.getLogger("lobby.connection")
+        self.loop = loop
+        self.protocol_factory = protocol_factory
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.backoff = backoff or Backoff()
+
+        self.state = DISCONNECTED
+        for state in STATES:
+            LOBBY_STATE.set(1 if state == self.state else 0, state)
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        self.log.debug("Lobby connection %s -> %s", self.state, state)
+        LOBBY_STATE.set(0, self.state)
+        LOBBY_STATE.set(1, state)
+        LOBBY_STATE_CHANGES.inc(state)
+        self.state = state
+
+    async def open(self) -> Tuple[asyncio.Transport, asyncio.Protocol]:
+        while True:
+            self._set_state(CONNECTING)
+            try:
+                connection = await asyncio.wait_for(
+                    self.loop.create_connection(self.protocol_factory, host=self.host, port=self.port,
+                                                ssl=self.use_ssl),
+                    self.timeout)
+            except asyncio.TimeoutError:
+                reason = "timeout"
+            except ssl.SSLError as e:
+                reason = "tls"
+                self.log.warning(f"TLS error connecting to {self.host}:{self.port}: {e}")
+            except OSError as e:
+                # refused, reset, unreachable and DNS failures
+                reason = type(e).__name__
+            else:
+                self._set_state(AUTHENTICATING)
+                self.log.info(f"Connected to {self.host}:{self.port}")
+                return connection
+
+            LOBBY_CONNECT_FAILURES.inc(reason)
+            delay = self.backoff.next()
+            self._set_state(BACKOFF)
+            self.log.info(f"Connecting to {self.host}:{self.port} failed ({reason}), "
+                          f"retry {self.backoff.attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def ready(self) -> None:
+        self.backoff.reset()
+        self._set_state(READY)
+
+    def lost(self) -> None:
+        self._set_state(DISCONNECTED)
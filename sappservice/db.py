@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from asyncpg import Connection
+
+from mautrix.util.async_db import PostgresDatabase, UpgradeTable
+
+from sappservice.state_store import BridgeStateStore
+
+upgrade_table = UpgradeTable()
+
+
+async def upgrade_database(url: str) -> None:
+    """
+    Bring the bridge and state store tables up to date and disconnect. The sharding supervisor
+    runs this before starting the workers, so they don't race each other through the upgrades.
+    """
+    db = PostgresDatabase(url, upgrade_table)
+    await db.start()
+    try:
+        await BridgeStateStore.upgrade_table.upgrade(db)
+    finally:
+        await db.stop()
+
+
+@upgrade_table.register(description="Lobby outbox")
+async def upgrade_v1(conn: Connection) -> None:
+    await conn.execute("""CREATE TABLE lobby_outbox (
+        id         BIGSERIAL PRIMARY KEY,
+        created_at DOUBLE PRECISION NOT NULL,
+        command    TEXT NOT NULL,
+        args       TEXT NOT NULL
+    )""")
+
+
+@upgrade_table.register(description="Snapshot of matrix users bridged to the lobby")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute("""CREATE TABLE lobby_bridged (
+        mxid        TEXT NOT NULL,
+        channel     TEXT NOT NULL,
+        domain      TEXT NOT NULL,
+        localpart   TEXT NOT NULL,
+        displayname TEXT NOT NULL,
+        PRIMARY KEY (mxid, channel)
+    )""")
+
+
+@upgrade_table.register(description="Shard of buffered lobby commands")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE lobby_outbox ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+    await conn.execute("CREATE INDEX lobby_outbox_shard_idx ON lobby_outbox (shard, id)")
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+
+from typing import List, Optional
+
+import aiohttp
+
+from mautrix.appservice import AppService
+
+log = logging.getLogger("httpclient")
+
+
+def homeserver_connector(limit: int = 100, limit_per_host: int = 0, keepalive_timeout: float = 60,
+                         dns_cache_ttl: int = 300, unix_socket: Optional[str] = None,
+                         verify_ssl: bool = True) -> aiohttp.BaseConnector:
+    """
+    Connector for homeserver requests. With ``unix_socket`` set, every request goes over that
+    socket whatever the host of the homeserver address is.
+    """
+    if unix_socket:
+        return aiohttp.UnixConnector(path=unix_socket, limit=limit, limit_per_host=limit_per_host,
+                                     keepalive_timeout=keepalive_timeout)
+    return aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                keepalive_timeout=keepalive_timeout,
+                                use_dns_cache=dns_cache_ttl > 0,
+                                ttl_dns_cache=dns_cache_ttl or None,
+                                ssl=None if verify_ssl else False)
+
+
+async def replace_session(appserv: AppService, connector: aiohttp.BaseConnector,
+                          trace_configs: List[aiohttp.TraceConfig] = ()) -> aiohttp.ClientSession:
+    """
+    Swap the client session mautrix created in ``AppService.start`` for one using ``connector``.
+
+    Must run right after the appservice started, before any puppet intent is created, since
+    intents keep a reference to the session they were created with.
+    """
+    old = appserv.http_session
+    session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": appserv.default_ua},
+                                    trace_configs=list(trace_configs))
+    appserv._http_session = session
+    appserv.intent.api.session = session
+    await old.close()
+    log.debug("Homeserver session uses %s (limit %s, per host %s)",
+              type(connector).__name__, connector.limit, connector.limit_per_host)
+    return session
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import re
+
+from typing import Dict, Iterable, NamedTuple, Optional
+
+# the lobby limits bridged domains and names to 15 characters
+MAX_LENGTH = 15
+
+DEFAULT_PREFIXES = {
+    "_discord_": "discord",
+    "freenode_": "freenode.org",
+    "spring_": "springlobby",
+}
+
+
+class LobbyIdentity(NamedTuple):
+    domain: str
+    name: str
+
+
+class IdentityMapper(object):
+    """
+    Maps matrix users to the lobby identity they are bridged as.
+
+    Users puppeted by another bridge are recognized by their localpart prefix (``prefixes`` maps
+    each prefix to the lobby domain of that network) and lose the prefix; everyone else keeps
+    the domain of their MXID. The prefixes are compiled into one regex, longest first, and
+    results are memoized per MXID. Returns None for users that must not be bridged: the
+    bridge bot, this bridge's own puppets and the ``ignore`` localparts.
+    """
+
+    def __init__(self, namespace: str, bot_username: str, prefixes: Optional[Dict[str, str]] = None,
+                 ignore: Iterable[str] = (), cache_size: int = 10000) -> None:
+        prefixes = DEFAULT_PREFIXES if prefixes is None else dict(prefixes)
+        self._domains = {prefix: str(domain) for prefix, domain in prefixes.items()}
+        self._prefix = None
+        if self._domains:
+            alternatives = sorted(self._domains, key=len, reverse=True)
+            self._prefix = re.compile("|".join(re.escape(prefix) for prefix in alternatives))
+        self._ignore = set(ignore) | {bot_username}
+        self._puppet_prefix = f"{namespace}_"
+
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, mxid: str) -> Optional[LobbyIdentity]:
+        localpart, _, domain = mxid[1:].partition(":")
+        if localpart in self._ignore or localpart.startswith(self._puppet_prefix):
+            return None
+
+        if self._prefix is not None:
+            match = self._prefix.match(localpart)
+            if match is not None:
+                domain = self._domains[match.group()]
+                localpart = localpart[match.end():]
+
+        return LobbyIdentity(domain[:MAX_LENGTH].replace("-", "_"), localpart[:MAX_LENGTH].lower())
+
+    @staticmethod
+    def display_name(displayname: Optional[str], identity: LobbyIdentity) -> str:
+        return (displayname or identity.name)[:MAX_LENGTH]
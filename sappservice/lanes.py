@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sappservice.metrics import LANE_WAIT
+
+# lower starts first
+LANE_CHAT = 0
+LANE_MEMBERSHIP = 1
+
+LANE_NAMES = {LANE_CHAT: "chat", LANE_MEMBERSHIP: "membership"}
+
+Key = Tuple[str, str]
+
+
+class _Event(object):
+    __slots__ = ("lane", "seq", "fn", "args", "keys", "waiting", "dependents", "submitted", "applied")
+
+    def __init__(self, lane: int, seq: int, fn: Callable[..., Awaitable[Any]], args: Tuple[Any, ...],
+                 keys: List[Key]) -> None:
+        self.lane = lane
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.keys = keys
+        self.waiting = 0
+        self.dependents: List["_Event"] = list()
+        self.submitted = time.monotonic()
+        # set while the event is queued downstream and its effect is pending
+        self.applied: Optional[asyncio.Future] = None
+
+
+class LaneDispatcher(object):
+    """
+    Starts lobby events by lane priority while keeping their order per channel and user.
+
+    Every event names the channel and the users it affects. An event only starts once the
+    earlier events for each of its (channel, user) pairs finished, so a line said right after
+    joining waits for the puppet's join and a leave waits for the lines said before it. Events
+    for other users do not wait.
+
+    At most ``concurrency`` events run at once. When that is reached, startable events wait
+    and chat events start first as slots free up. Membership events never take the last
+    ``chat_reserve`` slots, so a burst of membership changes waiting for their batches can not
+    hold up chat.
+
+    ``fn`` either returns once the event's effect happened (the message was sent), or hands
+    the event to a queue that keeps the order of its lane and returns a future that is done
+    once the effect happened (the membership batch was applied). In the latter case the slot
+    is freed right away and later events of the same lane and user start at once, so a join
+    and a leave can still meet (and cancel out) in one membership batch. Events of the other
+    lane keep waiting for the future.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, concurrency: int = 64, chat_reserve: int = 16) -> None:
+        self.log = logging.getLogger("lanes")
+        self.concurrency = concurrency
+        self.chat_reserve = min(chat_reserve, concurrency - 1)
+
+        self._tails: Dict[Key, _Event] = dict()
+        self._ready: List[Tuple[int, int, _Event]] = list()
+        self._seq = itertools.count()
+        self._running: Dict[asyncio.Future, _Event] = dict()
+        self._stopped = False
+
+        self.failed = 0
+
+    def submit(self, lane: int, channel: str, users: Iterable[str], fn: Callable[..., Awaitable[Any]],
+               *args: Any) -> None:
+        keys = [(channel, user) for user in set(users)]
+        event = _Event(lane, next(self._seq), fn, args, keys)
+        for key in keys:
+            tail = self._tails.get(key)
+            if tail is not None and not (tail.applied is not None and tail.lane == lane):
+                tail.dependents.append(event)
+                event.waiting += 1
+            self._tails[key] = event
+
+        if not event.waiting:
+            heapq.heappush(self._ready, (event.lane, event.seq, event))
+            self._start_ready()
+
+    def depths(self) -> Dict[str, int]:
+        """
+        Events waiting for a free slot, by lane.
+        """
+        depths = {name: 0 for name in LANE_NAMES.values()}
+        for lane, _, _ in self._ready:
+            depths[LANE_NAMES.get(lane, str(lane))] += 1
+        return depths
+
+    def _start_ready(self) -> None:
+        while self._ready and not self._stopped:
+            lane = self._ready[0][0]
+            limit = self.concurrency if lane == LANE_CHAT else self.concurrency - self.chat_reserve
+            if len(self._running) >= limit:
+                break
+            _, _, event = heapq.heappop(self._ready)
+            LANE_WAIT.observe(time.monotonic() - event.submitted, LANE_NAMES.get(event.lane, str(event.lane)))
+            task = asyncio.ensure_future(event.fn(*event.args))
+            self._running[task] = event
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Future) -> None:
+        event = self._running.pop(task)
+        result = None
+        if task.cancelled():
+            pass
+        elif task.exception() is not None:
+            self.failed += 1
+            self.log.error("Lobby event %s failed", getattr(event.fn, "__name__", event.fn),
+                           exc_info=task.exception())
+        else:
+            result = task.result()
+
+        if isinstance(result, asyncio.Future) and not result.done() and not self._stopped:
+            event.applied = result
+            waiting = list()
+            for dependent in event.dependents:
+                if dependent.lane == event.lane:
+                    self._release(dependent)
+                else:
+                    waiting.append(dependent)
+            event.dependents = waiting
+            result.add_done_callback(lambda _: self._done(event))
+        else:
+            self._done(event)
+        self._start_ready()
+
+    def _release(self, event: _Event) -> None:
+        event.waiting -= 1
+        if not event.waiting:
+            heapq.heappush(self._ready, (event.lane, event.seq, event))
+
+    def _done(self, event: _Event) -> None:
+        for key in event.keys:
+            if self._tails.get(key) is event:
+                del self._tails[key]
+        for dependent in event.dependents:
+            self._release(dependent)
+        self._start_ready()
+
+    async def stop(self, timeout: float = 5) -> None:
+        """
+        Wait at most ``timeout`` seconds for the started events, then cancel them. Events not
+        started yet are dropped.
+        """
+        self._stopped = True
+        if self._running:
+            _, pending = await asyncio.wait(list(self._running), timeout=timeout)
+            for task in pending:
+                task.cancel()
+        waiting = len(self._tails)
+        if waiting:
+            self.log.warning("Dropping lobby events of %s users still waiting at shutdown", waiting)
+        self._tails = dict()
+        self._ready = list()
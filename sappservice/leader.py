@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import zlib
+
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from mautrix.util.async_db import Database
+
+from sappservice.metrics import HA_LEADER
+
+
+def lock_key(as_token: str, shard: int = 0) -> int:
+    """
+    Advisory lock key shared by every instance of the same bridge (and shard).
+    """
+    return zlib.crc32(f"sappservice:{as_token}".encode("utf-8")) + shard
+
+
+class LeaderElection(object):
+    """
+    Active/standby election on a Postgres session-level advisory lock.
+
+    :meth:`acquire` holds a dedicated connection and retries ``pg_try_advisory_lock`` every
+    ``interval`` seconds until it gets the lock. Postgres releases the lock when the leader's
+    session ends, so a standby takes over within about ``interval`` seconds of the leader dying.
+    The leader checks its connection at the same interval and calls ``on_lost`` if it drops,
+    since a standby may already hold the lock by then.
+
+    Homeserver transactions are expected to reach the leader through a proxy that checks
+    ``/_matrix/mau/ready``. As a safety net, :meth:`middleware` makes a standby refuse
+    transactions, so the homeserver retries them instead of a standby handling them.
+    """
+
+    log: logging.Logger
+    db: Database
+
+    def __init__(self, db: Database, key: int, interval: float = 1.0,
+                 on_lost: Optional[Callable[[], None]] = None) -> None:
+        self.log = logging.getLogger("leader")
+        self.db = db
+        self.key = key
+        self.interval = interval
+        self.on_lost = on_lost
+
+        self.leader = False
+        self._conn = None
+        self._watch_task: Optional[asyncio.Future] = None
+        HA_LEADER.set(0)
+
+    async def acquire(self) -> None:
+        self._conn = await self.db.pool.acquire()
+        waiting = False
+        while not await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key):
+            if not waiting:
+                self.log.info(f"Another instance is the leader, standing by (lock {self.key})")
+                waiting = True
+            await asyncio.sleep(self.interval)
+
+        self.leader = True
+        HA_LEADER.set(1)
+        self.log.info(f"Elected leader (lock {self.key})")
+        self._watch_task = asyncio.ensure_future(self._watch())
+
+    def middleware(self) -> Callable:
+        @web.middleware
+        async def standby(request: web.Request,
+                          handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+            if not self.leader and "/transactions/" in request.path:
+                return web.json_response({"errcode": "M_UNKNOWN", "error": "Standby instance"}, status=503)
+            return await handler(request)
+        return standby
+
+    async def _watch(self) -> None:
+        while self.leader:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.wait_for(self._conn.fetchval("SELECT 1"), self.interval * 5)
+            except Exception:
+                self.log.critical("Lost the leader database session, stepping down", exc_info=True)
+                self.leader = False
+                HA_LEADER.set(0)
+                if self.on_lost is not None:
+                    self.on_lost()
+
+    async def release(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        if self._conn is None:
+            return
+        if self.leader:
+            self.leader = False
+            HA_LEADER.set(0)
+            try:
+                await self._conn.fetchval("SELECT pg_advisory_unlock($1)", self.key)
+            except Exception:
+                self.log.warning("Failed to release the leader lock", exc_info=True)
+        await self.db.pool.release(self._conn)
+        self._conn = None
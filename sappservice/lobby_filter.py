@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from typing import Dict, Tuple
+
+from sappservice.metrics import LOBBY_EVENTS_DROPPED
+from sappservice.rooms import RoomRegistry
+
+BATTLE_PREFIX = "__battle__"
+
+
+class LobbyEventFilter(object):
+    """
+    Drops lobby events for channels that are not bridged before any handler work is done.
+
+    The bridged channels are frozen into a set when the filter is built, so accepting an
+    event is one set lookup. Dropped events are counted per command and reason (``battle`` for
+    battle room channels, ``unbridged`` for every other channel).
+    """
+
+    def __init__(self, rooms: RoomRegistry) -> None:
+        self.channels = frozenset(room.channel for room in rooms)
+        self.dropped: Dict[Tuple[str, str], int] = dict()
+
+    def accept(self, command: str, channel: str) -> bool:
+        if channel in self.channels:
+            return True
+        reason = "battle" if channel.startswith(BATTLE_PREFIX) else "unbridged"
+        key = (command, reason)
+        self.dropped[key] = self.dropped.get(key, 0) + 1
+        LOBBY_EVENTS_DROPPED.inc(command, reason)
+        return False
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Dict, Iterable, List, Set
+
+JOIN = "join"
+LEAVE = "leave"
+
+ApplyFunc = Callable[[str, List[str], List[str]], Awaitable[None]]
+
+
+class MembershipBatcher(object):
+    """
+    Collects lobby joins and leaves per channel for ``window`` seconds and applies them as one batch.
+
+    A join and a leave of the same user inside one window cancel each other out. ``apply`` is
+    called with the channel and the usernames to join and to leave. ``join`` and ``leave``
+    return a future that is done once the batch they ended up in was applied.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, apply: ApplyFunc, window: float = 0.5) -> None:
+        self.log = logging.getLogger("membership")
+        self.apply = apply
+        self.window = window
+
+        self._pending: Dict[str, Dict[str, str]] = dict()
+        self._timers: Dict[str, asyncio.TimerHandle] = dict()
+        self._applied: Dict[str, asyncio.Future] = dict()
+        self._flushing: Set[asyncio.Future] = set()
+
+        self.cancelled = 0
+
+    def join(self, channel: str, usernames: Iterable[str]) -> asyncio.Future:
+        return self._add(channel, usernames, JOIN)
+
+    def leave(self, channel: str, usernames: Iterable[str]) -> asyncio.Future:
+        return self._add(channel, usernames, LEAVE)
+
+    def _add(self, channel: str, usernames: Iterable[str], op: str) -> asyncio.Future:
+        pending = self._pending.get(channel)
+        if pending is None:
+            pending = self._pending[channel] = dict()
+
+        for username in usernames:
+            previous = pending.get(username)
+            if previous is not None and previous != op:
+                # joined and left (or left and joined) again before anything was sent
+                del pending[username]
+                self.cancelled += 1
+            else:
+                pending[username] = op
+
+        if channel not in self._timers:
+            self._timers[channel] = asyncio.get_event_loop().call_later(self.window, self._flush_soon, channel)
+
+        applied = self._applied.get(channel)
+        if applied is None:
+            applied = self._applied[channel] = asyncio.get_event_loop().create_future()
+        return applied
+
+    def _flush_soon(self, channel: str) -> None:
+        del self._timers[channel]
+        task = asyncio.ensure_future(self.flush(channel))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self, channel: str) -> None:
+        pending = self._pending.pop(channel, None)
+        applied = self._applied.pop(channel, None)
+        try:
+            if pending:
+                await self._apply(channel, pending)
+        finally:
+            if applied is not None and not applied.done():
+                applied.set_result(None)
+
+    async def _apply(self, channel: str, pending: Dict[str, str]) -> None:
+        joins = [username for username, op in pending.items() if op == JOIN]
+        leaves = [username for username, op in pending.items() if op == LEAVE]
+        self.log.debug(f"Applying {len(joins)} joins and {len(leaves)} leaves in {channel}")
+        try:
+            await self.apply(channel, joins, leaves)
+        except Exception:
+            self.log.exception(f"Failed to apply membership changes in {channel}")
+
+    async def stop(self) -> None:
+        """
+        Apply every pending batch now.
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers = dict()
+        await asyncio.gather(*(self.flush(channel) for channel in list(self._pending)))
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
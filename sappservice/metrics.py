@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Minimal Prometheus text-format metrics, served on ``/metrics`` of the appservice web server.
+"""
+
+import functools
+import time
+
+from bisect import bisect_left
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import aiohttp
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    labels = [f"{name}=\"{_escape(str(value))}\"" for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return f"{{{','.join(labels)}}}" if labels else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.type}",
+                *self.samples()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = dict()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    A gauge that is either set directly or read from ``collect`` at scrape time. ``collect``
+    returns a mapping of label value tuples to values.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[LabelValues, float]]] = None) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = dict()
+        self.collect = collect
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self._values)
+        if self.collect is not None:
+            values.update(self.collect())
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: bucket counts (non-cumulative, last one is +Inf), sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, *labels: str) -> None:
+        try:
+            counts, total = self._values[labels]
+        except KeyError:
+            counts, total = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def time(self, *labels: str) -> Callable:
+        """
+        Decorator observing the run time of a coroutine function.
+        """
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.monotonic()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.observe(time.monotonic() - start, *labels)
+            return wrapper
+        return decorator
+
+    def samples(self) -> Iterable[str]:
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f"le=\"{_format_value(bound)}\""
+                yield f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}"
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = dict()
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = list()
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+
+REGISTRY = Registry()
+
+EVENTS = REGISTRY.register(Counter("sappservice_matrix_events_total",
+                                   "Matrix events received from the homeserver", ["type"]))
+LOBBY_EVENTS = REGISTRY.register(Counter("sappservice_lobby_events_total",
+                                         "Lobby events received from the lobby server", ["command"]))
+LOBBY_EVENTS_DROPPED = REGISTRY.register(Counter("sappservice_lobby_events_dropped_total",
+                                                 "Lobby events dropped before dispatch", ["command", "reason"]))
+HANDLER_LATENCY = REGISTRY.register(Histogram("sappservice_handler_seconds",
+                                              "Time spent relaying an event", ["direction", "handler"]))
+OUTBOUND_QUEUE_DEPTH = REGISTRY.register(Gauge("sappservice_outbound_queue_depth",
+                                               "Lobby messages waiting to be sent to matrix", ["channel"]))
+HOMESERVER_LATENCY = REGISTRY.register(Histogram("sappservice_homeserver_request_seconds",
+                                                 "Homeserver request latency", ["method"]))
+HOMESERVER_ERRORS = REGISTRY.register(Counter("sappservice_homeserver_request_errors_total",
+                                              "Failed homeserver requests", ["method", "reason"]))
+HOMESERVER_CONNECTIONS = REGISTRY.register(Counter("sappservice_homeserver_connections_total",
+                                                   "Homeserver requests by whether they opened a new connection",
+                                                   ["connection"]))
+HOMESERVER_CONNECT_LATENCY = REGISTRY.register(Histogram("sappservice_homeserver_connect_seconds",
+                                                         "Time spent opening homeserver connections"))
+LOBBY_RECONNECTS = REGISTRY.register(Counter("sappservice_lobby_reconnects_total",
+                                             "Reconnects to the lobby server"))
+PROFILE_CACHE = REGISTRY.register(Gauge("sappservice_profile_cache", "Displayname cache counters",
+                                        ["stat"]))
+LOOP_LAG = REGISTRY.register(Histogram("sappservice_event_loop_lag_seconds",
+                                      "How late the event loop runs scheduled callbacks",
+                                      buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)))
+SLOW_CALLBACKS = REGISTRY.register(Counter("sappservice_event_loop_stalls_total",
+                                           "Times the event loop was blocked longer than the threshold"))
+LOBBY_STATE = REGISTRY.register(Gauge("sappservice_lobby_connection_state",
+                                      "1 for the current state of the lobby connection", ["state"]))
+LOBBY_STATE_CHANGES = REGISTRY.register(Counter("sappservice_lobby_connection_state_changes_total",
+                                                "Lobby connection state transitions by new state", ["state"]))
+LOBBY_CONNECT_FAILURES = REGISTRY.register(Counter("sappservice_lobby_connect_failures_total",
+                                                   "Failed lobby connection attempts", ["reason"]))
+STARTUP_STAGE_SECONDS = REGISTRY.register(Gauge("sappservice_startup_stage_seconds",
+                                                "How long each startup stage took", ["stage"]))
+LANE_WAIT = REGISTRY.register(Histogram("sappservice_lobby_event_wait_seconds",
+                                        "Time lobby events wait for earlier events of the same user "
+                                        "and a free slot", ["lane"]))
+LANE_QUEUE_DEPTH = REGISTRY.register(Gauge("sappservice_lobby_event_queue_depth",
+                                           "Lobby events waiting for a free slot", ["lane"]))
+HA_LEADER = REGISTRY.register(Gauge("sappservice_leader", "1 if this instance holds the leader lock"))
+SCHEDULER_WAIT = REGISTRY.register(Histogram("sappservice_scheduler_wait_seconds",
+                                             "Time homeserver requests wait for a rate limit token",
+                                             ["priority"]))
+SCHEDULER_RETRIES = REGISTRY.register(Counter("sappservice_scheduler_retries_total",
+                                              "Retried homeserver requests", ["reason"]))
+
+
+def homeserver_trace_config() -> aiohttp.TraceConfig:
+    """
+    aiohttp trace hooks recording the latency and errors of homeserver requests, and how often
+    they had to open a new connection instead of reusing a pooled one.
+    """
+
+    async def on_request_start(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                               params: aiohttp.TraceRequestStartParams) -> None:
+        ctx.start = time.monotonic()
+
+    async def on_request_end(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                             params: aiohttp.TraceRequestEndParams) -> None:
+        HOMESERVER_LATENCY.observe(time.monotonic() - ctx.start, params.method)
+        if params.response.status >= 400:
+            HOMESERVER_ERRORS.inc(params.method, str(params.response.status))
+
+    async def on_connection_create_start(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                         params: aiohttp.TraceConnectionCreateStartParams) -> None:
+        ctx.connect_start = time.monotonic()
+
+    async def on_connection_create_end(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                       params: aiohttp.TraceConnectionCreateEndParams) -> None:
+        HOMESERVER_CONNECT_LATENCY.observe(time.monotonic() - ctx.connect_start)
+        HOMESERVER_CONNECTIONS.inc("new")
+
+    async def on_connection_reuseconn(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                      params: aiohttp.TraceConnectionReuseconnParams) -> None:
+        HOMESERVER_CONNECTIONS.inc("reused")
+
+    async def on_request_exception(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                   params: aiohttp.TraceRequestExceptionParams) -> None:
+        HOMESERVER_LATENCY.observe(time.monotonic() - ctx.start, params.method)
+        HOMESERVER_ERRORS.inc(params.method, type(params.exception).__name__)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    return trace_config
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import logging
+import signal
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+from aiohttp import web
+
+from sappservice.metrics import LOOP_LAG, SLOW_CALLBACKS
+
+
+def _all_tasks(loop: asyncio.AbstractEventLoop):
+    all_tasks = getattr(asyncio, "all_tasks", None)
+    if all_tasks is None:
+        return asyncio.Task.all_tasks(loop)
+    return all_tasks(loop)
+
+
+def _format_frame(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+
+class LoopMonitor(object):
+    """
+    Event loop instrumentation.
+
+    A callback scheduled every ``interval`` seconds measures how late the loop runs it (loop
+    lag). A watchdog thread checks that the callback keeps running; when the loop has not
+    run it for ``slow_callback`` seconds, whatever the loop thread is executing is logged with
+    its stack. Running tasks can be dumped, and the loop thread can be sampled for a while to
+    get a collapsed-stack profile.
+    """
+
+    log: logging.Logger
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.1,
+                 lag_warning: float = 0.1, slow_callback: float = 0.25,
+                 asyncio_debug: bool = False) -> None:
+        self.log = logging.getLogger("monitor")
+        self.loop = loop
+        self.interval = interval
+        self.lag_warning = lag_warning
+        self.slow_callback = slow_callback
+        self.asyncio_debug = asyncio_debug
+
+        self._loop_thread: Optional[int] = None
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._expected = 0.0
+        self._beat = 0.0
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """
+        Start monitoring. Must be called from the loop thread.
+        """
+        self._loop_thread = threading.get_ident()
+
+        if self.asyncio_debug:
+            # asyncio's own slow callback logging, precise but expensive
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.slow_callback
+
+        self._beat = time.monotonic()
+        self._schedule()
+
+        if self.slow_callback:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self) -> None:
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._tick)
+
+    def _tick(self) -> None:
+        lag = max(0.0, self.loop.time() - self._expected)
+        self._beat = time.monotonic()
+        LOOP_LAG.observe(lag)
+        if lag > self.lag_warning:
+            self.log.warning("Event loop lag %.3fs", lag)
+        self._schedule()
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.slow_callback or beat == reported:
+                continue
+            reported = beat
+            SLOW_CALLBACKS.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<unknown>"
+            self.log.warning("Event loop blocked for %.3fs, currently running:\n%s", stalled, stack)
+
+    def dump_tasks(self) -> str:
+        tasks = list(_all_tasks(self.loop))
+        out = io.StringIO()
+        out.write(f"{len(tasks)} tasks\n")
+        for task in tasks:
+            out.write("\n")
+            task.print_stack(file=out)
+        return out.getvalue()
+
+    def profile(self, duration: float = 5, interval: float = 0.005) -> str:
+        """
+        Sample the loop thread's stack for ``duration`` seconds. Must not be called from the loop
+        thread. Returns the samples in collapsed-stack format, one ``frame;frame;... count`` line
+        per distinct stack, as consumed by flamegraph tools.
+        """
+        samples: Counter = Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = list()
+            while frame is not None:
+                stack.append(_format_frame(frame))
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+    async def handle_tasks(self, _: web.Request) -> web.Response:
+        return web.Response(text=self.dump_tasks())
+
+    async def handle_profile(self, request: web.Request) -> web.Response:
+        try:
+            duration = min(float(request.query.get("seconds", 5)), 60)
+        except ValueError:
+            return web.Response(status=400, text="seconds must be a number")
+        result = await self.loop.run_in_executor(None, self.profile, duration)
+        return web.Response(text=result)
+
+    def register_routes(self, app: web.Application, prefix: str = "/debug") -> None:
+        app.router.add_get(f"{prefix}/tasks", self.handle_tasks)
+        app.router.add_get(f"{prefix}/profile", self.handle_profile)
+
+    def add_signal_handlers(self) -> None:
+        """
+        SIGUSR1 logs the running tasks, SIGUSR2 logs a 5 second profile of the loop thread.
+        """
+        self.loop.add_signal_handler(signal.SIGUSR1,
+                                     lambda: self.log.warning("Running tasks:\n%s", self.dump_tasks()))
+        self.loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(self._log_profile()))
+
+    async def _log_profile(self) -> None:
+        result = await self.loop.run_in_executor(None, self.profile, 5)
+        self.log.warning("Event loop profile:\n%s", result)
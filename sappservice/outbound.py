@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+Job = Tuple[Callable[..., Awaitable[Any]], Tuple[Any, ...], Optional[asyncio.Future]]
+
+
+class OutboundDispatcher(object):
+    """
+    Ordered per-room queues drained by a bounded pool of workers.
+
+    Jobs submitted with the same key run one at a time in submission order, jobs for different
+    keys run concurrently on up to ``workers`` workers. When a queue holds ``max_queue_size``
+    jobs the ``overflow`` policy decides whether the submitter waits (``block``), the oldest
+    queued job is dropped (``drop_oldest``) or the new job is dropped (``drop_newest``).
+    """
+
+    log: logging.Logger
+
+    def __init__(self, workers: int = 4, max_queue_size: int = 1000,
+                 overflow: str = OVERFLOW_BLOCK) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+
+        self.log = logging.getLogger("outbound")
+
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+
+        self._queues: Dict[str, Deque[Job]] = dict()
+        self._space: Dict[str, asyncio.Event] = dict()
+        self._scheduled: Set[str] = set()
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = list()
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self.log.debug(f"Starting {self.workers} outbound workers")
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5) -> None:
+        """
+        Drain the queued jobs for at most ``timeout`` seconds, then stop the workers.
+        """
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f"Dropping {self.depth()} outbound jobs still queued at shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = list()
+
+    def depth(self, key: str = None) -> int:
+        if key is not None:
+            queue = self._queues.get(key)
+            return len(queue) if queue else 0
+        return sum(len(queue) for queue in self._queues.values())
+
+    def depths(self) -> Dict[str, int]:
+        return {key: len(queue) for key, queue in self._queues.items()}
+
+    async def submit(self, key: str, fn: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        """
+        Queue ``fn(*args)`` behind the jobs already queued for ``key``.
+
+        Returns False if the job was dropped by the overflow policy.
+        """
+        return await self._submit(key, fn, args, None)
+
+    async def run(self, key: str, fn: Callable[..., Awaitable[Any]], *args: Any) -> bool:
+        """
+        Like :meth:`submit`, but wait until the job ran. Returns False if it was dropped.
+        """
+        done = asyncio.get_event_loop().create_future()
+        if not await self._submit(key, fn, args, done):
+            return False
+        return await done
+
+    async def _submit(self, key: str, fn: Callable[..., Awaitable[Any]], args: Tuple[Any, ...],
+                      done: Optional[asyncio.Future]) -> bool:
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+
+        while len(queue) >= self.max_queue_size:
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                self.log.warning(f"Outbound queue for {key} full, dropping new job")
+                return False
+            elif self.overflow == OVERFLOW_DROP_OLDEST:
+                _, _, dropped = queue.popleft()
+                if dropped is not None:
+                    dropped.set_result(False)
+                self._job_done()
+                self.dropped += 1
+                self.log.warning(f"Outbound queue for {key} full, dropping oldest job")
+            else:
+                space = self._space.get(key)
+                if space is None:
+                    space = self._space[key] = asyncio.Event()
+                space.clear()
+                await space.wait()
+
+        queue.append((fn, args, done))
+        self._pending += 1
+        self._idle.clear()
+
+        # a key is handed to one worker at a time, which keeps its jobs in order
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._ready.put_nowait(key)
+        return True
+
+    def _job_done(self) -> None:
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+
+            queue = self._queues[key]
+            if not queue:
+                self._scheduled.discard(key)
+                continue
+            fn, args, done = queue.popleft()
+
+            space = self._space.get(key)
+            if space is not None:
+                space.set()
+
+            try:
+                await fn(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                self.log.exception(f"Outbound job for {key} failed")
+            finally:
+                if done is not None and not done.done():
+                    done.set_result(True)
+                self._job_done()
+                # go to the back of the line so busy rooms don't starve the others
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    self._scheduled.discard(key)
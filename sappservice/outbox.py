@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import time
+
+from typing import Any, Callable
+
+from mautrix.util.async_db import Database
+
+COMMANDS = ("say_from", "join_from", "leave_from", "bridged_client_from")
+
+
+class LobbyOutbox(object):
+    """
+    Sends lobby-bound commands, buffering them in the database while the lobby is unavailable.
+
+    Buffered commands are replayed in order by :meth:`replay` once the lobby accepted the
+    login again. At most ``max_size`` commands are kept (oldest dropped first), and commands older
+    than ``max_age`` seconds are dropped at replay time.
+    """
+
+    log: logging.Logger
+    db: Database
+
+    def __init__(self, db: Database, connected: Callable[[], bool], max_size: int = 10000,
+                 max_age: float = 3600, batch_size: int = 500, shard: int = 0) -> None:
+        self.log = logging.getLogger("lobby.outbox")
+        self.db = db
+        self.connected = connected
+        self.max_size = max_size
+        self.max_age = max_age
+        self.batch_size = batch_size
+        # in sharded mode every worker replays only the commands it buffered itself
+        self.shard = shard
+
+        self.bot = None
+        self.ready = False
+        self._size = 0
+        # stores and replays run one at a time, so a command is either replayed or sent after
+        # the replay, never stranded in the table or sent ahead of older ones
+        self._lock = asyncio.Lock()
+        self._waiting = 0
+
+        self.buffered = 0
+        self.replayed = 0
+        self.expired = 0
+
+    async def start(self) -> None:
+        self._size = await self.db.fetchval("SELECT COUNT(*) FROM lobby_outbox WHERE shard=$1", self.shard)
+        if self._size:
+            self.log.info("%d lobby commands buffered from a previous run", self._size)
+
+    def disconnected(self) -> None:
+        if self.ready:
+            self.log.info("Lobby unavailable, buffering lobby commands")
+        self.ready = False
+
+    async def send(self, command: str, *args: Any) -> None:
+        if command not in COMMANDS:
+            raise ValueError(f"Unknown lobby command {command}")
+
+        if self.ready and not self._waiting and self.connected():
+            getattr(self.bot, command)(*args)
+            return
+
+        self._waiting += 1
+        try:
+            async with self._lock:
+                if self.ready and self.connected():
+                    getattr(self.bot, command)(*args)
+                    return
+                self.disconnected()
+                await self._store(command, args)
+        finally:
+            self._waiting -= 1
+
+    async def _store(self, command: str, args: tuple) -> None:
+        await self.db.execute("INSERT INTO lobby_outbox (created_at, command, args, shard) "
+                              "VALUES ($1, $2, $3, $4)", time.time(), command, json.dumps(args), self.shard)
+        self.buffered += 1
+        self._size += 1
+
+        if self._size > self.max_size:
+            excess = self._size - self.max_size
+            await self.db.execute("DELETE FROM lobby_outbox WHERE id IN (SELECT id FROM lobby_outbox "
+                                  "WHERE shard=$1 ORDER BY id LIMIT $2)", self.shard, excess)
+            self._size -= excess
+            self.expired += excess
+            self.log.warning("Lobby outbox full, dropped %d oldest commands", excess)
+
+    async def replay(self, bot: Any) -> None:
+        """
+        Send every buffered command to ``bot`` in order, then send directly again.
+        """
+        async with self._lock:
+            await self._replay(bot)
+
+    async def _replay(self, bot: Any) -> None:
+        self.bot = bot
+
+        expired = await self.db.fetchval("WITH expired AS (DELETE FROM lobby_outbox WHERE shard=$1 AND "
+                                         "created_at < $2 RETURNING id) SELECT COUNT(*) FROM expired",
+                                         self.shard, time.time() - self.max_age)
+        if expired:
+            self.expired += expired
+            self.log.warning("Dropped %d buffered lobby commands older than %ss", expired, self.max_age)
+
+        replayed = 0
+        while True:
+            rows = await self.db.fetch("SELECT id, command, args FROM lobby_outbox WHERE shard=$1 "
+                                       "ORDER BY id LIMIT $2", self.shard, self.batch_size)
+            if not rows:
+                break
+            sent = list()
+            try:
+                for row in rows:
+                    if not self.connected():
+                        break
+                    getattr(bot, row["command"])(*json.loads(row["args"]))
+                    sent.append(row["id"])
+            except Exception:
+                self.log.exception("Failed to replay a buffered lobby command")
+            if sent:
+                await self.db.execute("DELETE FROM lobby_outbox WHERE id = ANY($1)", sent)
+                self._size -= len(sent)
+            replayed += len(sent)
+            if len(sent) < len(rows):
+                # the rest stays buffered for the next replay
+                self.replayed += replayed
+                self.log.warning("Lobby connection lost after replaying %d buffered lobby commands", replayed)
+                return
+
+        # stores wait for the lock, so nothing was added since the last empty fetch
+        self._size = 0
+        self.ready = True
+        self.replayed += replayed
+        if replayed:
+            self.log.info("Replayed %d buffered lobby commands", replayed)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from mautrix.appservice import AppService
+from mautrix.errors import MNotFound
+from mautrix.types import UserID
+
+from sappservice.scheduler import PRIORITY_PROFILE, RequestScheduler
+
+
+class ProfileCache(object):
+    """
+    LRU + TTL cache of matrix displaynames.
+
+    Users without a profile are cached too (for ``negative_ttl`` seconds) so repeated lookups of
+    the same unknown user do not hit the homeserver. Concurrent lookups of the same user share a
+    single request.
+    """
+
+    log: logging.Logger
+    appserv: AppService
+
+    def __init__(self, appserv: AppService, max_size: int = 10000, ttl: float = 3600,
+                 negative_ttl: float = 300, scheduler: Optional[RequestScheduler] = None) -> None:
+        self.log = logging.getLogger("profile_cache")
+        self.appserv = appserv
+        self.scheduler = scheduler
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._entries: "OrderedDict[UserID, Tuple[float, Optional[str]]]" = OrderedDict()
+        self._pending: Dict[UserID, asyncio.Future] = dict()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, user_id: UserID) -> Tuple[bool, Optional[str]]:
+        try:
+            expires, displayname = self._entries[user_id]
+        except KeyError:
+            return False, None
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return False, None
+        self._entries.move_to_end(user_id)
+        return True, displayname
+
+    def _store(self, user_id: UserID, displayname: Optional[str]) -> None:
+        ttl = self.ttl if displayname is not None else self.negative_ttl
+        self._entries[user_id] = (time.monotonic() + ttl, displayname)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, user_id: UserID, displayname: Optional[str]) -> None:
+        """
+        Store a displayname learned from somewhere else, e.g. an m.room.member event.
+        """
+        self._store(user_id, displayname or None)
+
+    def invalidate(self, user_id: UserID) -> None:
+        self._entries.pop(user_id, None)
+
+    async def get_displayname(self, user_id: UserID) -> Optional[str]:
+        found, displayname = self._lookup(user_id)
+        if found:
+            if displayname is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return displayname
+
+        pending = self._pending.get(user_id)
+        if pending is not None:
+            self.hits += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # the lookup we waited for was cancelled along with its caller, do our own
+                return await self.get_displayname(user_id)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[user_id] = future
+        try:
+            try:
+                if self.scheduler is not None:
+                    displayname = await self.scheduler.run(self.appserv.intent.get_displayname, user_id,
+                                                           priority=PRIORITY_PROFILE)
+                else:
+                    displayname = await self.appserv.intent.get_displayname(user_id)
+            except MNotFound:
+                displayname = None
+            self._store(user_id, displayname or None)
+            future.set_result(displayname or None)
+            return displayname or None
+        except Exception as e:
+            future.set_exception(e)
+            # nobody else may be waiting, don't leave the exception unretrieved
+            future.exception()
+            raise
+        finally:
+            del self._pending[user_id]
+            # cancelled: release the concurrent callers waiting on this lookup
+            if not future.done():
+                future.cancel()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
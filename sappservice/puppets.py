@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from mautrix.appservice import AppService, IntentAPI
+from mautrix.types import RoomID, UserID
+
+
+class Puppet(object):
+    """
+    The matrix side of a lobby user.
+    """
+
+    __slots__ = ("username", "mxid", "_intent", "rooms")
+
+    def __init__(self, username: str, mxid: UserID) -> None:
+        self.username = username
+        self.mxid = mxid
+        self._intent: Optional[IntentAPI] = None
+        # rooms this puppet is known to be joined to
+        self.rooms: Set[RoomID] = set()
+
+    @property
+    def online(self) -> bool:
+        return bool(self.rooms)
+
+    def __repr__(self) -> str:
+        return f"Puppet({self.username!r}, {self.mxid!r}, rooms={len(self.rooms)})"
+
+
+class PuppetRegistry(object):
+    """
+    Puppets of lobby users keyed by lobby username.
+
+    Holds at most ``max_size`` puppets. When full, the least recently used puppets that are not
+    joined to any room are evicted first.
+    """
+
+    log: logging.Logger
+    appserv: AppService
+
+    def __init__(self, appserv: AppService, namespace: str, domain: str, max_size: int = 50000) -> None:
+        self.log = logging.getLogger("puppets")
+        self.appserv = appserv
+        self.max_size = max_size
+
+        self._mxid_prefix = f"@{namespace}_"
+        self._mxid_suffix = f":{domain}"
+        self._puppets: "OrderedDict[str, Puppet]" = OrderedDict()
+        self._by_mxid: Dict[UserID, Puppet] = dict()
+
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._puppets)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._puppets
+
+    def get(self, username: str) -> Puppet:
+        puppet = self._puppets.get(username)
+        if puppet is not None:
+            self._puppets.move_to_end(username)
+            return puppet
+
+        puppet = Puppet(username, UserID(f"{self._mxid_prefix}{username.lower()}{self._mxid_suffix}"))
+        self._puppets[username] = puppet
+        self._by_mxid[puppet.mxid] = puppet
+        if len(self._puppets) > self.max_size:
+            self._evict()
+        return puppet
+
+    def intent(self, username: str) -> IntentAPI:
+        puppet = self.get(username)
+        if puppet._intent is None:
+            puppet._intent = self.appserv.intent.user(puppet.mxid)
+        return puppet._intent
+
+    def joined(self, username: str, room_id: RoomID) -> None:
+        self.get(username).rooms.add(room_id)
+
+    def left(self, username: str, room_id: RoomID) -> None:
+        puppet = self._puppets.get(username)
+        if puppet is not None:
+            puppet.rooms.discard(room_id)
+
+    def left_matrix(self, mxid: UserID, room_id: RoomID) -> None:
+        """
+        A puppet left or was removed from a room on the matrix side (kick, ban, leave by the
+        homeserver), so the next lobby join joins it again instead of skipping it.
+        """
+        puppet = self._by_mxid.get(mxid)
+        if puppet is not None:
+            puppet.rooms.discard(room_id)
+
+    def forget(self, username: str) -> None:
+        puppet = self._puppets.pop(username, None)
+        if puppet is not None:
+            self._by_mxid.pop(puppet.mxid, None)
+
+    def _evict(self) -> None:
+        # evict down to 90% of max_size so a full registry doesn't scan on every insert
+        excess = len(self._puppets) - int(self.max_size * 0.9)
+        offline = list()
+        for username, puppet in self._puppets.items():
+            if len(offline) >= excess:
+                break
+            if not puppet.rooms:
+                offline.append(username)
+        for username in offline:
+            self._by_mxid.pop(self._puppets.pop(username).mxid, None)
+        self.evictions += len(offline)
+
+        # everyone left is still in a room, fall back to plain LRU
+        for _ in range(excess - len(offline)):
+            _, puppet = self._puppets.popitem(last=False)
+            self._by_mxid.pop(puppet.mxid, None)
+            self.evictions += 1
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+
+from typing import Dict, Optional, Set
+
+from mautrix.appservice import AppService
+from mautrix.types import EventID, RoomID
+
+from sappservice.scheduler import PRIORITY_PROFILE, RequestScheduler
+
+
+class ReceiptCoalescer(object):
+    """
+    Sends the appservice bot's read receipts in the background.
+
+    Only the latest event of each room is remembered, and all rooms are flushed together
+    ``delay`` seconds after the first unsent receipt.
+    """
+
+    log: logging.Logger
+    appserv: AppService
+
+    def __init__(self, appserv: AppService, delay: float = 1.0,
+                 scheduler: Optional[RequestScheduler] = None) -> None:
+        self.log = logging.getLogger("receipts")
+        self.appserv = appserv
+        self.delay = delay
+        self.scheduler = scheduler
+
+        self._latest: Dict[RoomID, EventID] = dict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Set[asyncio.Future] = set()
+
+        self.marked = 0
+        self.sent = 0
+
+    def mark_read(self, room_id: RoomID, event_id: EventID) -> None:
+        self._latest[room_id] = event_id
+        self.marked += 1
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.delay, self._flush_soon)
+
+    def _flush_soon(self) -> None:
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self) -> None:
+        if not self._latest:
+            return
+        receipts, self._latest = self._latest, dict()
+        await asyncio.gather(*(self._send(room_id, event_id) for room_id, event_id in receipts.items()))
+
+    async def _send(self, room_id: RoomID, event_id: EventID) -> None:
+        try:
+            if self.scheduler is not None:
+                await self.scheduler.run(self.appserv.intent.mark_read, room_id=room_id, event_id=event_id,
+                                         priority=PRIORITY_PROFILE)
+            else:
+                await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+            self.sent += 1
+        except Exception:
+            self.log.exception(f"Failed to send read receipt for {event_id} in {room_id}")
+
+    async def stop(self) -> None:
+        """
+        Send every pending receipt now.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
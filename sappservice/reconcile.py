@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mautrix.types import UserID
+from mautrix.util.async_db import Database
+
+# (lobby domain, external id, display name)
+Identity = Tuple[str, str, str]
+Key = Tuple[UserID, str]
+
+
+class BridgedSnapshot(object):
+    """
+    What the bridge last told the lobby: the identity of every matrix user bridged to each
+    channel. Persisted so a reconnect only has to send the lobby what changed since.
+    """
+
+    log: logging.Logger
+    db: Database
+
+    def __init__(self, db: Database) -> None:
+        self.log = logging.getLogger("reconcile")
+        self.db = db
+        self.entries: Dict[Key, Identity] = dict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def load(self, channels: Optional[Iterable[str]] = None) -> None:
+        """
+        Load the snapshot, limited to ``channels`` when given (the channels of a shard).
+        """
+        if channels is None:
+            rows = await self.db.fetch("SELECT mxid, channel, domain, localpart, displayname FROM lobby_bridged")
+        else:
+            rows = await self.db.fetch("SELECT mxid, channel, domain, localpart, displayname FROM lobby_bridged "
+                                       "WHERE channel = ANY($1::text[])", list(channels))
+        self.entries = {(UserID(row["mxid"]), row["channel"]):
+                        (row["domain"], row["localpart"], row["displayname"])
+                        for row in rows}
+        self.log.debug("Loaded %d bridged memberships", len(self.entries))
+
+    def diff(self, desired: Dict[Key, Identity]) -> Tuple[Dict[Key, Identity], List[Key]]:
+        """
+        Compare ``desired`` with the snapshot. Returns the entries that are new or whose identity
+        changed, and the keys that are no longer wanted.
+        """
+        changed = {key: identity for key, identity in desired.items() if self.entries.get(key) != identity}
+        removed = [key for key in self.entries if key not in desired]
+        return changed, removed
+
+    async def save(self, changed: Dict[Key, Identity], removed: Iterable[Key]) -> None:
+        removed = list(removed)
+        async with self.db.acquire() as conn:
+            if changed:
+                await conn.executemany("INSERT INTO lobby_bridged (mxid, channel, domain, localpart, displayname) "
+                                       "VALUES ($1, $2, $3, $4, $5) "
+                                       "ON CONFLICT (mxid, channel) DO UPDATE "
+                                       "SET domain=excluded.domain, localpart=excluded.localpart, "
+                                       "displayname=excluded.displayname",
+                                       [(mxid, channel, *identity) for (mxid, channel), identity in changed.items()])
+            if removed:
+                await conn.executemany("DELETE FROM lobby_bridged WHERE mxid=$1 AND channel=$2", removed)
+
+        self.entries.update(changed)
+        for key in removed:
+            self.entries.pop(key, None)
+
+    async def add(self, mxid: UserID, channel: str, identity: Identity) -> None:
+        if self.entries.get((mxid, channel)) != identity:
+            await self.save({(mxid, channel): identity}, ())
+
+    async def remove(self, mxid: UserID, channel: str) -> None:
+        if (mxid, channel) in self.entries:
+            await self.save({}, [(mxid, channel)])
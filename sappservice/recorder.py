@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import gzip
+import json
+import logging
+import time
+
+from typing import IO, Any, Iterator, List, Optional, Tuple
+
+from mautrix.types import Event
+
+LOBBY = "lobby"
+MATRIX = "matrix"
+START = "start"
+
+
+def _open(path: str, mode: str) -> IO:
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, str, Any]]:
+    """
+    Yield the ``(offset, kind, data)`` records of a capture file. Offsets are seconds since the
+    start of the recording; a file appended to by several runs restarts at 0 for each run.
+    """
+    with _open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                offset, kind, data = json.loads(line)
+                yield offset, kind, data
+
+
+class TrafficRecorder(object):
+    """
+    Captures the lobby protocol lines received by the bridge and the matrix events delivered by
+    the homeserver to an append-only file, gzip compressed if the path ends in ``.gz``.
+
+    Every record is a JSON array on its own line: ``[offset, "lobby", line]`` or
+    ``[offset, "matrix", event]``, offsets in seconds since the recording started. Records are
+    buffered and written by the default executor every ``flush_interval`` seconds.
+    """
+
+    log: logging.Logger
+    loop: asyncio.AbstractEventLoop
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop, flush_interval: float = 1.0,
+                 lobby: bool = True, matrix: bool = True) -> None:
+        self.log = logging.getLogger("recorder")
+        self.path = path
+        self.loop = loop
+        self.flush_interval = flush_interval
+        self.lobby = lobby
+        self.matrix = matrix
+
+        self.records = 0
+        self._file: Optional[IO] = None
+        self._buffer: List[str] = list()
+        self._started = 0.0
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._writing: Optional[asyncio.Future] = None
+
+    def start(self) -> None:
+        self._file = _open(self.path, "a")
+        self._started = time.monotonic()
+        self._append(START, time.time())
+        self._handle = self.loop.call_later(self.flush_interval, self._flush)
+        self.log.info("Recording %s traffic to %s",
+                      " and ".join(kind for kind, on in ((LOBBY, self.lobby), (MATRIX, self.matrix)) if on),
+                      self.path)
+
+    def _append(self, kind: str, data: Any) -> None:
+        self._buffer.append(json.dumps([round(time.monotonic() - self._started, 6), kind, data],
+                                       separators=(",", ":")))
+        self.records += 1
+
+    def _write(self, lines: List[str]) -> None:
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+
+    def _flush(self) -> None:
+        if self._buffer and (self._writing is None or self._writing.done()):
+            lines, self._buffer = self._buffer, list()
+            self._writing = self.loop.run_in_executor(None, self._write, lines)
+        self._handle = self.loop.call_later(self.flush_interval, self._flush)
+
+    async def stop(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._writing is not None:
+            await self._writing
+        if self._buffer:
+            lines, self._buffer = self._buffer, list()
+            await self.loop.run_in_executor(None, self._write, lines)
+        self._file.close()
+        self.log.info("Recorded %d records to %s", self.records, self.path)
+
+    def record_lobby(self, line: str) -> None:
+        if self.lobby:
+            self._append(LOBBY, line)
+
+    async def record_event(self, event: Event) -> None:
+        if self.matrix:
+            self._append(MATRIX, event.serialize())
+
+    def wrap_protocol(self, protocol: asyncio.Protocol) -> asyncio.Protocol:
+        """
+        Record every line the lobby sends on ``protocol`` before the protocol handles it.
+        """
+        data_received = protocol.data_received
+        partial = [b""]
+
+        def recording_data_received(data: bytes) -> None:
+            lines = (partial[0] + data).split(b"\n")
+            partial[0] = lines.pop()
+            for line in lines:
+                self.record_lobby(line.decode("utf-8", errors="replace").rstrip("\r"))
+            data_received(data)
+
+        protocol.data_received = recording_data_received
+        return protocol
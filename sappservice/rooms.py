@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from mautrix.types import RoomID
+
+
+def _as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+class BridgedRoom(object):
+    """
+    A bridged channel as configured in ``bridge.rooms``.
+    """
+
+    __slots__ = ("channel", "name", "room_id", "enabled")
+
+    def __init__(self, channel: str, name: str, room_id: RoomID, enabled: bool) -> None:
+        # lobby channel as it arrives in lobby events (the bridge.rooms key)
+        self.channel = channel
+        # lobby channel name used when talking to the lobby on behalf of matrix users
+        self.name = name
+        self.room_id = room_id
+        self.enabled = enabled
+
+    def __repr__(self) -> str:
+        return f"BridgedRoom({self.channel!r}, room_id={self.room_id!r}, enabled={self.enabled})"
+
+
+class RoomRegistry(object):
+    """
+    Bidirectional index between lobby channels and matrix rooms.
+
+    Built once from ``bridge.rooms`` so every lookup on the event hot paths is a dict access.
+    """
+
+    def __init__(self, rooms: Dict[str, Dict[str, Any]]) -> None:
+        self._by_channel: Dict[str, BridgedRoom] = dict()
+        self._by_room_id: Dict[RoomID, BridgedRoom] = dict()
+
+        for channel, room_data in (rooms or {}).items():
+            room = BridgedRoom(channel=channel,
+                               name=room_data.get("name") or channel,
+                               room_id=RoomID(room_data["room_id"]),
+                               enabled=_as_bool(room_data.get("enabled")))
+            self._by_channel[channel] = room
+            self._by_room_id[room.room_id] = room
+
+        self._enabled: List[BridgedRoom] = [room for room in self._by_channel.values() if room.enabled]
+
+    def by_channel(self, channel: str) -> Optional[BridgedRoom]:
+        return self._by_channel.get(channel)
+
+    def by_room_id(self, room_id: RoomID) -> Optional[BridgedRoom]:
+        return self._by_room_id.get(room_id)
+
+    def room_id_for(self, channel: str) -> Optional[RoomID]:
+        room = self._by_channel.get(channel)
+        return room.room_id if room else None
+
+    def channel_for(self, room_id: RoomID) -> Optional[str]:
+        room = self._by_room_id.get(room_id)
+        return room.channel if room else None
+
+    @property
+    def enabled(self) -> List[BridgedRoom]:
+        return self._enabled
+
+    def __iter__(self) -> Iterator[BridgedRoom]:
+        return iter(self._by_channel.values())
+
+    def __len__(self) -> int:
+        return len(self._by_channel)
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self._by_channel
@@ -22,6 +22,7 @@
 import sys
 import argparse
 import asyncio
+import atexit
 import logging.config
 import signal
 import traceback
@@ -31,7 +32,6 @@ from urllib.parse import urlparse
 
 import copy
 
-from mautrix.appservice.state_store.asyncpg import PgASStateStore
 from mautrix.bridge import BaseBridgeConfig
 from mautrix.errors import MForbidden
 from mautrix.types import (EventID, RoomID, UserID, Event, EventType, MessageEvent, MessageType,
@@ -39,9 +39,20 @@ from mautrix.types import (EventID, RoomID, UserID, Event, EventType, MessageEve
 from mautrix.appservice import AppService
 # from mautrix.util.async_db import Database
 from mautrix.util.async_db import PostgresDatabase
-from mautrix.util.async_db import UpgradeTable
 
 from sappservice.config import Config
+from sappservice.connection import Backoff
+from sappservice.db import upgrade_table
+from sappservice.httpclient import homeserver_connector, replace_session
+from sappservice.lanes import LANE_CHAT, LANE_MEMBERSHIP
+from sappservice.leader import LeaderElection, lock_key
+from sappservice.monitor import LoopMonitor
+from sappservice.recorder import TrafficRecorder
+from sappservice.sharding import apply_shard
+from sappservice import metrics
+from sappservice.startup import Startup
+from sappservice.state_store import BridgeStateStore
+from sappservice.util.log import setup_queue_logging
 
 from sappservice.spring_lobby_client import SpringLobbyClient
 
@@ -63,7 +74,7 @@ class Matrix:
     async def handle_message(self, room_id: RoomID, user_id: UserID, message: MessageEventContent,
                              event_id: EventID) -> None:
 
-        self.log.debug(f"message \"{message.body}\" from {user_id} to {room_id}:")
+        self.log.debug("message \"%s\" from %s to %s:", message.body, user_id, room_id)
 
         if message.msgtype == MessageType.TEXT:
             await self.sl.say_from_matrix(user_id, room_id, event_id, message.body)
@@ -86,14 +97,13 @@ class Matrix:
             await self.sl.say_from_matrix(user_id, room_id, event_id, url)
 
         else:
-            self.log.debug(f"Unhandled message type {message.msgtype}")
+            self.log.debug("Unhandled message type %s", message.msgtype)
 
     async def handle_event(self, event: Event) -> None:
 
         self.log.debug("Handle event")
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
+        metrics.EVENTS.inc(str(event.type))
 
         event_type: str = event.get("type", "m.unknown")
         room_id: Optional[RoomID] = event.get("room_id", None)
@@ -101,18 +111,28 @@ class Matrix:
         sender: Optional[UserID] = event.get("sender", None)
         content: Dict = event.get("content", {})
 
-        self.log.debug(f"Event {event}")
+        self.log.debug("Event %s", event)
 
-        self.log.debug(f"Event type: {event.type}")
-        self.log.debug(f"Event room_id: {room_id}")
-        self.log.debug(f"Event sender: {sender}")
-        self.log.debug(f"Event content: {content}")
+        self.log.debug("Event type: %s", event.type)
+        self.log.debug("Event room_id: %s", room_id)
+        self.log.debug("Event sender: %s", sender)
+        self.log.debug("Event content: %s", content)
+
+        if room_id is not None and self.sl.rooms.by_room_id(room_id) is None:
+            self.log.debug("Ignoring event from unbridged room %s", room_id)
+            return
 
         if event.type == EventType.ROOM_MEMBER:
             event: StateEvent
             prev_content = event.unsigned.prev_content or MemberStateEventContent()
             prev_membership = prev_content.membership if prev_content else Membership.JOIN
 
+            if event.content.membership == Membership.JOIN:
+                self.sl.profiles.update(UserID(event.state_key), event.content.displayname)
+
+            if event.content.membership in (Membership.LEAVE, Membership.BAN):
+                self.sl.puppets.left_matrix(UserID(event.state_key), event.room_id)
+
             if event.content.membership == Membership.LEAVE:
                 if event.sender == event.state_key:
                     await self.sl.matrix_user_left(UserID(event.state_key), event.room_id, event.event_id)
@@ -128,7 +148,7 @@ class Matrix:
 
     async def wait_for_connection(self) -> None:
         self.log.info("Ensuring connectivity to homeserver")
-        errors = 0
+        backoff = Backoff(first=0.5, initial=1, maximum=10)
         while True:
             try:
                 await self.az.intent.whoami()
@@ -136,10 +156,10 @@ class Matrix:
             except MForbidden:
                 raise
             except Exception:
-                errors += 1
-                if errors <= 6:
-                    self.log.exception("Connection to homeserver failed, retrying in 10 seconds")
-                    await asyncio.sleep(10)
+                if backoff.attempt < 10:
+                    delay = backoff.next()
+                    self.log.exception(f"Connection to homeserver failed, retrying in {delay:.1f} seconds")
+                    await asyncio.sleep(delay)
                 else:
                     raise
 
@@ -161,12 +181,18 @@ class Matrix:
                 self.log.exception("Failed to set bot avatar")
 
 
-async def sappservice(config_filename, loop):
+async def sappservice(config_filename, loop, shard=None, shards=1):
     config = Config(config_filename, "", "")
     config.load()
+    if shard is not None:
+        apply_shard(config, shard, shards)
 
     logging.config.dictConfig(copy.deepcopy(config["logging"]))
 
+    if config["log_queue"]:
+        for listener in setup_queue_logging():
+            atexit.register(listener.stop)
+
     log: logging.Logger = logging.getLogger("sappservice")
 
     log.info("Initializing matrix spring lobby appservice")
@@ -200,13 +226,9 @@ async def sappservice(config_filename, loop):
     client_name = config["spring.client_name"]
     rooms = config["bridge.rooms"]
     
-    upgrade_table = UpgradeTable()
-
     db = PostgresDatabase(config["appservice.database"], upgrade_table)
-    await db.start()
 
-    state_store_db = PgASStateStore(db=db)
-    await state_store_db.upgrade_table.upgrade(db.pool)
+    state_store_db = BridgeStateStore(db=db)
 
     appserv = AppService(server=server,
                          domain=domain,
@@ -222,11 +244,31 @@ async def sappservice(config_filename, loop):
                          state_store=state_store_db,
                          aiohttp_params={"client_max_size": max_body_size * mebibyte})
 
-    spring_lobby_client = SpringLobbyClient(appserv, config, loop=loop)
-
-    await db.start()
-    await appserv.start(hostname, port)
-    await spring_lobby_client.start()
+    spring_lobby_client = SpringLobbyClient(appserv, config, loop=loop, db=db)
+
+    startup = Startup()
+    startup.register_routes(appserv.app, config["startup.health_path"] or "/health")
+
+    if config["metrics.enabled"]:
+        appserv.app.router.add_get(config["metrics.path"] or "/metrics", metrics.REGISTRY.handle)
+        metrics.OUTBOUND_QUEUE_DEPTH.collect = lambda: {
+            (channel,): depth for channel, depth in spring_lobby_client.outbound.depths().items()}
+        metrics.PROFILE_CACHE.collect = lambda: {
+            (stat,): value for stat, value in spring_lobby_client.profiles.stats().items()}
+        metrics.LANE_QUEUE_DEPTH.collect = lambda: {
+            (lane,): depth for lane, depth in spring_lobby_client.lanes.depths().items()}
+
+    monitor = None
+    if config["monitor.enabled"]:
+        monitor = LoopMonitor(loop,
+                              interval=config["monitor.interval"] or 0.1,
+                              lag_warning=config.get_or("monitor.lag_warning", 0.1),
+                              slow_callback=config.get_or("monitor.slow_callback", 0.25),
+                              asyncio_debug=bool(config["monitor.asyncio_debug"]))
+        if config["monitor.debug_endpoints"]:
+            monitor.register_routes(appserv.app)
+        monitor.start()
+        monitor.add_signal_handlers()
 
     ################
     #
@@ -234,101 +276,198 @@ async def sappservice(config_filename, loop):
     #
     ################
 
-    @spring_lobby_client.bot.on("tasserver")
-    async def on_lobby_tasserver(message):
-        log.debug(f"on_lobby_tasserver {message}")
-        if message.client.name == client_name:
-            message.client._login()
-
-    @spring_lobby_client.bot.on("clients")
-    async def on_lobby_clients(message):
-        log.debug(f"on_lobby_clients {message}")
-        if message.client.name != client_name:
-            channel = message.params[0]
-            clients = message.params[1:]
-            await spring_lobby_client.join_matrix_room(channel, clients)
-
-    @spring_lobby_client.bot.on("joined")
-    async def on_lobby_joined(message, user, channel):
-        log.debug(f"LOBBY JOINED user: {user.username} room: {channel}")
-        if user.username != "appservice":
-            await spring_lobby_client.join_matrix_room(channel, [user.username])
-
-    @spring_lobby_client.bot.on("left")
-    async def on_lobby_left(message, user, channel):
-        log.debug(f"LOBBY LEFT user: {user.username} room: {channel}")
-
-        if channel.startswith("__battle__"):
-            return
+    def register_lobby_handlers():
+
+        # drops events of battle rooms and unbridged channels before any other work
+        accept = spring_lobby_client.lobby_filter.accept
+
+        @spring_lobby_client.bot.on("tasserver")
+        async def on_lobby_tasserver(message):
+            metrics.LOBBY_EVENTS.inc("tasserver")
+            log.debug("on_lobby_tasserver %s", message)
+            if message.client.name == client_name:
+                message.client._login()
+
+        @spring_lobby_client.bot.on("clients")
+        async def on_lobby_clients(message):
+            metrics.LOBBY_EVENTS.inc("clients")
+            if not accept("clients", message.params[0]):
+                return
+            log.debug("on_lobby_clients %s", message)
+            if message.client.name != client_name:
+                channel = message.params[0]
+                clients = message.params[1:]
+                spring_lobby_client.lanes.submit(LANE_MEMBERSHIP, channel, clients,
+                                                 spring_lobby_client.join_matrix_room, channel, clients)
+
+        @spring_lobby_client.bot.on("joined")
+        async def on_lobby_joined(message, user, channel):
+            metrics.LOBBY_EVENTS.inc("joined")
+            if not accept("joined", channel):
+                return
+            log.debug("LOBBY JOINED user: %s room: %s", user.username, channel)
+            if user.username != "appservice":
+                spring_lobby_client.lanes.submit(LANE_MEMBERSHIP, channel, [user.username],
+                                                 spring_lobby_client.join_matrix_room, channel, [user.username])
+
+        @spring_lobby_client.bot.on("left")
+        async def on_lobby_left(message, user, channel):
+            metrics.LOBBY_EVENTS.inc("left")
+            if not accept("left", channel):
+                return
+            log.debug("LOBBY LEFT user: %s room: %s", user.username, channel)
+
+            if user.username == "appservice":
+                return
+
+            spring_lobby_client.lanes.submit(LANE_MEMBERSHIP, channel, [user.username],
+                                             spring_lobby_client.leave_matrix_room, channel, [user.username])
+
+        @spring_lobby_client.bot.on("said")
+        async def on_lobby_said(message, user, target, text):
+            metrics.LOBBY_EVENTS.inc("said")
+            if message.client.name == client_name and accept("said", target):
+                spring_lobby_client.lanes.submit(LANE_CHAT, target, [user], spring_lobby_client.outbound.run,
+                                                 target, spring_lobby_client.said, user, target, text)
+
+        @spring_lobby_client.bot.on("saidex")
+        async def on_lobby_saidex(message, user, target, text):
+            metrics.LOBBY_EVENTS.inc("saidex")
+            if message.client.name == client_name and accept("saidex", target):
+                spring_lobby_client.lanes.submit(LANE_CHAT, target, [user], spring_lobby_client.outbound.run,
+                                                 target, spring_lobby_client.saidex, user, target, text)
+
+        # @spring_lobby_client.bot.on("denied")
+        # async def on_lobby_denied(message):
+        #     return
+        #     # if message.client.name != client_name:
+        #     #    user = message.client.name
+        #     #    await spring_appservice.register(user)
+
+        # @spring_lobby_client.bot.on("adduser")
+        # async def on_lobby_adduser(message):
+        #     if message.client.name != client_name:
+        #         username = message.params[0]
+        #
+        #         if username == "ChanServ":
+        #             return
+        #         if username == "appservice":
+        #             return
+        #
+        #         await spring_lobby_client.login_matrix_account(username)
+
+        # @spring_lobby_client.bot.on("removeuser")
+        # async def on_lobby_removeuser(message):
+        #     if message.client.name != client_name:
+        #         username = message.params[0]
+        #
+        #         if username == "ChanServ":
+        #             return
+        #         if username == "appservice":
+        #             return
+        #
+        #         await spring_lobby_client.logout_matrix_account(username)
+
+        @spring_lobby_client.bot.on("accepted")
+        async def on_lobby_accepted(message):
+            metrics.LOBBY_EVENTS.inc("accepted")
+            log.debug("message Accepted %s", message)
+            spring_lobby_client.lobby_accepted()
+            try:
+                await spring_lobby_client.config_rooms()
+                await spring_lobby_client.sync_matrix_users()
+            except Exception:
+                log.exception("Failed to resync rooms and users after the lobby login")
+            finally:
+                # relay matrix -> lobby commands even if the resync failed
+                await spring_lobby_client.outbox.replay(spring_lobby_client.bot)
+
+        @spring_lobby_client.bot.on("failed")
+        async def on_lobby_failed(message):
+            metrics.LOBBY_EVENTS.inc("failed")
+            log.debug("message FAILED %s", message)
+
+    if config["recorder.path"]:
+        recorder = TrafficRecorder(config["recorder.path"], loop,
+                                   flush_interval=config["recorder.flush_interval"] or 1.0,
+                                   lobby=config["recorder.lobby"] is not False,
+                                   matrix=config["recorder.matrix"] is not False)
+        recorder.start()
+        spring_lobby_client.recorder = recorder
+        appserv.matrix_event_handler(recorder.record_event)
 
-        if user.username == "appservice":
-            return
+    matrix = Matrix(appserv, spring_lobby_client, config)
 
-        await spring_lobby_client.leave_matrix_room(channel, [user.username])
-
-    @spring_lobby_client.bot.on("said")
-    async def on_lobby_said(message, user, target, text):
-        if message.client.name == client_name:
-            await spring_lobby_client.said(user, target, text)
-
-    @spring_lobby_client.bot.on("saidex")
-    async def on_lobby_saidex(message, user, target, text):
-        if message.client.name == client_name:
-            await spring_lobby_client.saidex(user, target, text)
-
-    # @spring_lobby_client.bot.on("denied")
-    # async def on_lobby_denied(message):
-    #     return
-    #     # if message.client.name != client_name:
-    #     #    user = message.client.name
-    #     #    await spring_appservice.register(user)
-
-    # @spring_lobby_client.bot.on("adduser")
-    # async def on_lobby_adduser(message):
-    #     if message.client.name != client_name:
-    #         username = message.params[0]
-    #
-    #         if username == "ChanServ":
-    #             return
-    #         if username == "appservice":
-    #             return
-    #
-    #         await spring_lobby_client.login_matrix_account(username)
+    appserv.matrix_event_handler(matrix.handle_event)
 
-    # @spring_lobby_client.bot.on("removeuser")
-    # async def on_lobby_removeuser(message):
-    #     if message.client.name != client_name:
-    #         username = message.params[0]
+    ################
     #
-    #         if username == "ChanServ":
-    #             return
-    #         if username == "appservice":
-    #             return
+    # Startup
     #
-    #         await spring_lobby_client.logout_matrix_account(username)
-
-    @spring_lobby_client.bot.on("accepted")
-    async def on_lobby_accepted(message):
-        log.debug(f"message Accepted {message}")
-        await spring_lobby_client.config_rooms()
-        await spring_lobby_client.sync_matrix_users()
-
-    @spring_lobby_client.bot.on("failed")
-    async def on_lobby_failed(message):
-        log.debug(f"message FAILED {message}")
-
-    matrix = Matrix(appserv, spring_lobby_client, config)
-
-    appserv.matrix_event_handler(matrix.handle_event)
+    ################
 
-    await matrix.wait_for_connection()
-    await matrix.init_as_bot()
+    async def start_database():
+        await db.start()
+        await state_store_db.upgrade_table.upgrade(db)
+
+    async def start_appservice():
+        await appserv.start(hostname, port)
+        trace_configs = [spring_lobby_client.scheduler.trace_config()]
+        if config["metrics.enabled"]:
+            trace_configs.append(metrics.homeserver_trace_config())
+        connector = homeserver_connector(limit=config.get_or("homeserver.http.limit", 100),
+                                         limit_per_host=config.get_or("homeserver.http.limit_per_host", 0),
+                                         keepalive_timeout=config.get_or("homeserver.http.keepalive_timeout", 60),
+                                         dns_cache_ttl=config.get_or("homeserver.http.dns_cache_ttl", 300),
+                                         unix_socket=config["homeserver.http.unix_socket"],
+                                         verify_ssl=bool(verify_ssl))
+        await replace_session(appserv, connector, trace_configs)
+        # matrix -> lobby commands are buffered in the lobby outbox until the lobby is ready,
+        # so transactions can be accepted as soon as the database and web server are up.
+        # In HA mode only the leader is ready, see start_leader.
+        if not config["ha.enabled"]:
+            appserv.ready = True
+
+    async def start_homeserver():
+        await matrix.wait_for_connection()
+        await asyncio.gather(matrix.init_as_bot(),
+                             appserv.intent.set_presence(PresenceState.ONLINE))
+
+    async def start_lobby():
+        await spring_lobby_client.start()
+        register_lobby_handlers()
+
+    startup.add("database", start_database)
+    startup.add("appservice", start_appservice, requires=["database"])
+    startup.add("homeserver", start_homeserver, requires=["appservice"])
+
+    if config["ha.enabled"]:
+        # the standby stays unready, refuses transactions and stays disconnected from the
+        # lobby until it gets the lock
+        election = LeaderElection(db, key=config["ha.lock_key"] or lock_key(as_token, config["sharding.shard"] or 0),
+                                  interval=config["ha.interval"] or 1.0,
+                                  on_lost=lambda: asyncio.ensure_future(spring_lobby_client.exit("leadership")))
+        appserv.app.middlewares.append(election.middleware())
+
+        async def start_leader():
+            await election.acquire()
+            appserv.ready = True
+
+        startup.add("warm", spring_lobby_client.warm, requires=["homeserver"])
+        startup.add("leader", start_leader, requires=["database", "appservice"])
+        startup.add("lobby", start_lobby, requires=["database", "appservice", "warm", "leader"])
+    else:
+        startup.add("lobby", start_lobby, requires=["database", "appservice"])
+
+    # installed before startup, so a standby waiting for the leader lock can be stopped too
+    for signame in ('SIGINT', 'SIGTERM'):
+        loop.add_signal_handler(getattr(signal, signame),
+                                lambda signame=signame: asyncio.ensure_future(spring_lobby_client.exit(signame)))
+    await startup.run()
 
     # appservice_account = await appserv.intent.whoami()
     # user = appserv.intent.user(appservice_account)
 
-    await appserv.intent.set_presence(PresenceState.ONLINE)
-
     # location = config["homeserver"]["domain"].split(".")[0]
     # external_id = "MatrixAppService"
     # external_username = config["appservice"]["bot_username"].split("_")[1]
@@ -349,9 +488,4 @@ async def sappservice(config_filename, loop):
     #     #     except Exception as e:
     #     #         log.debug(f"Failed to leave room, not previously joined: {e}")
 
-    appserv.ready = True
     log.info("Initialization complete, running startup actions")
-
-    for signame in ('SIGINT', 'SIGTERM'):
-        loop.add_signal_handler(getattr(signal, signame),
-                                lambda: asyncio.ensure_future(spring_lobby_client.exit(signame)))
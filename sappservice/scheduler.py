@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+import aiohttp
+
+from mautrix.errors import MatrixConnectionError, MatrixRequestError, MLimitExceeded
+
+from sappservice.connection import Backoff
+from sappservice.metrics import SCHEDULER_RETRIES, SCHEDULER_WAIT
+
+# lower runs first
+PRIORITY_MESSAGE = 0
+PRIORITY_MEMBERSHIP = 1
+PRIORITY_PROFILE = 2
+
+PRIORITY_NAMES = {PRIORITY_MESSAGE: "message", PRIORITY_MEMBERSHIP: "membership", PRIORITY_PROFILE: "profile"}
+
+
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "last", "paused_until")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self) -> float:
+        """
+        Take a token if one is available and return 0, otherwise return how long to wait.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler(object):
+    """
+    Central gate for homeserver requests.
+
+    Every request first takes a token from the bucket of the user it is made as (``key``), then
+    one from the global bucket. Requests waiting for a global token are released in priority
+    order, so message sends go ahead of membership changes and profile traffic.
+
+    ``M_LIMIT_EXCEEDED`` responses pause the bucket of the limited user for the
+    ``retry_after_ms`` the homeserver asked for (read by the trace hooks installed with
+    :meth:`trace_config`) and the request is retried. Idempotent requests are also retried on
+    connection errors and 5xx responses; message sends stay idempotent by reusing their
+    transaction ID across attempts.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, rate: float = 50, burst: float = 100, user_rate: float = 10, user_burst: float = 20,
+                 max_retries: int = 5, max_users: int = 10000, bot_mxid: Optional[str] = None) -> None:
+        self.log = logging.getLogger("scheduler")
+        # requests made as the bridge bot are scheduled with key=None
+        self.bot_mxid = bot_mxid
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_retries = max_retries
+        self.max_users = max_users
+
+        self._global = TokenBucket(rate, burst)
+        self._users: "OrderedDict[Optional[str], TokenBucket]" = OrderedDict()
+        self._waiting: List[Tuple[int, int, asyncio.Future]] = list()
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Future] = None
+
+        self._txn_prefix = f"sapps{int(time.time() * 1000)}"
+        self._txn_ids = itertools.count()
+
+    def txn_id(self) -> str:
+        return f"{self._txn_prefix}.{next(self._txn_ids)}"
+
+    def _bucket(self, key: Optional[str]) -> TokenBucket:
+        bucket = self._users.get(key)
+        if bucket is None:
+            bucket = self._users[key] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(key)
+        return bucket
+
+    def pause(self, key: Optional[str], seconds: float) -> None:
+        self.log.warning("Rate limited as %s, pausing for %.2fs", key or "the bridge bot", seconds)
+        self._bucket(key).pause(seconds)
+
+    async def _acquire(self, key: Optional[str], priority: int) -> None:
+        bucket = self._bucket(key)
+        delay = bucket.take()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = bucket.take()
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._global.take()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                # cancelled while waiting, give the token to the next one
+                self._global.tokens += 1
+            else:
+                future.set_result(None)
+
+    async def stop(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    async def run(self, fn: Callable[..., Awaitable[Any]], *args: Any, key: Optional[str] = None,
+                  priority: int = PRIORITY_MESSAGE, idempotent: bool = True, **kwargs: Any) -> Any:
+        backoff = Backoff(first=0.5, initial=1, maximum=30)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await self._acquire(key, priority)
+            SCHEDULER_WAIT.observe(time.monotonic() - started, PRIORITY_NAMES.get(priority, str(priority)))
+            try:
+                return await fn(*args, **kwargs)
+            except MLimitExceeded as e:
+                error = e
+                reason = "rate_limited"
+                # the trace hook paused the bucket for retry_after_ms, back off if it didn't
+                delay = 0 if self._bucket(key).paused_until > time.monotonic() else backoff.next()
+            except MatrixRequestError as e:
+                if not idempotent or getattr(e, "http_status", 0) < 500:
+                    raise
+                error = e
+                reason = "server_error"
+                delay = backoff.next()
+            except (MatrixConnectionError, asyncio.TimeoutError) as e:
+                if not idempotent:
+                    raise
+                error = e
+                reason = "connection"
+                delay = backoff.next()
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            SCHEDULER_RETRIES.inc(reason)
+            self.log.debug("Retrying %s as %s (%s, attempt %d)", getattr(fn, "__name__", fn), key, reason, attempt)
+            if delay:
+                await asyncio.sleep(delay)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_end(_: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                 params: aiohttp.TraceRequestEndParams) -> None:
+            if params.response.status != 429:
+                return
+            try:
+                retry_after = (await params.response.json()).get("retry_after_ms", 0) / 1000
+            except (ValueError, aiohttp.ContentTypeError):
+                retry_after = 0
+            if retry_after:
+                # appservice requests carry the MXID they are made as, the bot's included
+                user_id = params.url.query.get("user_id")
+                self.pause(None if user_id == self.bot_mxid else user_id, retry_after)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
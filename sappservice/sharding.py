@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sharded mode: a supervisor process runs N bridge workers, each with its own lobby connection and
+its own share of ``bridge.rooms``, and routes the homeserver's transactions to them by room.
+"""
+
+import asyncio
+import copy
+import json
+import logging.config
+import os
+import signal
+import sys
+import zlib
+
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from aiohttp import web
+
+from sappservice.config import Config
+from sappservice.connection import Backoff
+from sappservice.db import upgrade_database
+
+# transaction fields holding lists of events, routed by room_id
+EVENT_FIELDS = ("events", "ephemeral", "de.sorunome.msc2409.ephemeral")
+
+
+def shard_for(room_id: str, shards: int) -> int:
+    return zlib.crc32(room_id.encode("utf-8")) % shards
+
+
+def shard_rooms(rooms: Dict[str, Dict[str, Any]], shards: int, shard: int) -> Dict[str, Dict[str, Any]]:
+    return {channel: room for channel, room in (rooms or {}).items()
+            if shard_for(str(room["room_id"]), shards) == shard}
+
+
+def worker_port(config: Config, shard: int) -> int:
+    base = config["sharding.worker_base_port"] or int(config["appservice.port"]) + 1
+    return int(base) + shard
+
+
+def configured_shards(config_filename: str) -> int:
+    config = Config(config_filename, "", "")
+    config.load()
+    return int(config["sharding.shards"] or 1)
+
+
+def shard_path(path: str, shard: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.{shard}{ext}"
+
+
+def apply_shard(config: Config, shard: int, shards: int) -> None:
+    """
+    Narrow a loaded config to one worker: its rooms, its lobby account, its local port and its
+    own log and capture files. The values are set as overrides, so MATRIX_SPRING_* environment
+    variables meant for the whole bridge can not make the workers collide.
+    """
+    config.override("sharding.shard", shard)
+    config.override("sharding.shards", shards)
+    config.override("bridge.rooms", shard_rooms(config["bridge.rooms"], shards, shard))
+    config.override("appservice.hostname", "127.0.0.1")
+    config.override("appservice.port", worker_port(config, shard))
+
+    accounts = config["sharding.lobby_accounts"] or []
+    if shard < len(accounts):
+        config.override("spring.bot_username", accounts[shard]["username"])
+        config.override("spring.bot_password", accounts[shard]["password"])
+    elif shard > 0:
+        # the lobby allows one session per account
+        config.override("spring.bot_username", f"{config['spring.bot_username']}{shard}")
+
+    logging_config = copy.deepcopy(config["logging"])
+    for handler in (logging_config.get("handlers") or {}).values():
+        if handler.get("filename"):
+            handler["filename"] = shard_path(handler["filename"], shard)
+    config.override("logging", logging_config)
+    if config["recorder.path"]:
+        config.override("recorder.path", shard_path(config["recorder.path"], shard))
+
+    config.settings = config.resolve_settings()
+
+
+class TransactionRouter(object):
+    """
+    Receives the homeserver's appservice transactions on the public appservice port and forwards
+    each worker the events of its rooms, under the same transaction ID. Events without a room
+    and every other request go to shard 0.
+
+    A transaction is only acknowledged once every worker involved accepted its part, so a failed
+    worker makes the homeserver retry; workers that already handled that transaction ID skip it.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, hs_token: str, workers: List[str], max_body_size: int) -> None:
+        self.log = logging.getLogger("sharding.router")
+        self.hs_token = hs_token
+        self.workers = workers
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(client_max_size=max_body_size)
+        self.app.router.add_route("PUT", "/transactions/{transaction_id}", self.handle_transaction)
+        self.app.router.add_route("PUT", "/_matrix/app/v1/transactions/{transaction_id}",
+                                  self.handle_transaction)
+        self.app.router.add_route("*", "/{path:.*}", self.handle_proxy)
+
+    async def start(self, host: str, port: int) -> None:
+        self.session = aiohttp.ClientSession()
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.log.info(f"Routing transactions on {host}:{port} to {len(self.workers)} workers")
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+        await self.session.close()
+
+    def _check_token(self, request: web.Request) -> bool:
+        token = request.query.get("access_token")
+        if token is None:
+            token = request.headers.get("Authorization", "")[len("Bearer "):]
+        return token == self.hs_token
+
+    def split(self, transaction: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
+        parts: Dict[int, Dict[str, Any]] = {0: dict()}
+        for field, value in transaction.items():
+            if field not in EVENT_FIELDS or not isinstance(value, list):
+                parts[0][field] = value
+                continue
+            for event in value:
+                room_id = event.get("room_id")
+                shard = shard_for(room_id, len(self.workers)) if room_id else 0
+                parts.setdefault(shard, dict()).setdefault(field, []).append(event)
+        return {shard: part for shard, part in parts.items() if part}
+
+    async def _forward(self, shard: int, transaction_id: str, part: Dict[str, Any]) -> bool:
+        url = f"{self.workers[shard]}/transactions/{transaction_id}"
+        try:
+            async with self.session.put(url, params={"access_token": self.hs_token},
+                                        data=json.dumps(part),
+                                        headers={"Content-Type": "application/json"}) as response:
+                if response.status < 400:
+                    return True
+                self.log.warning(f"Worker {shard} rejected transaction {transaction_id}: {response.status}")
+        except aiohttp.ClientError as e:
+            self.log.warning(f"Worker {shard} unreachable for transaction {transaction_id}: {e}")
+        return False
+
+    async def handle_transaction(self, request: web.Request) -> web.Response:
+        if not self._check_token(request):
+            return web.json_response({"error": "Invalid auth token", "errcode": "M_UNKNOWN_TOKEN"},
+                                     status=401)
+        try:
+            transaction = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Body is not JSON", "errcode": "M_NOT_JSON"}, status=400)
+
+        transaction_id = request.match_info["transaction_id"]
+        parts = self.split(transaction)
+        results = await asyncio.gather(*[self._forward(shard, transaction_id, part)
+                                         for shard, part in parts.items()])
+        if not all(results):
+            return web.json_response({"error": "Worker unavailable", "errcode": "M_UNKNOWN"}, status=502)
+        return web.json_response({})
+
+    async def handle_proxy(self, request: web.Request) -> web.Response:
+        headers = {key: value for key, value in request.headers.items()
+                   if key.lower() in ("authorization", "content-type")}
+        try:
+            async with self.session.request(request.method, f"{self.workers[0]}{request.path}",
+                                            params=request.query, headers=headers,
+                                            data=await request.read()) as response:
+                return web.Response(status=response.status, body=await response.read(),
+                                    content_type=response.content_type)
+        except aiohttp.ClientError:
+            return web.json_response({"error": "Worker unavailable", "errcode": "M_UNKNOWN"}, status=502)
+
+
+class Supervisor(object):
+    """
+    Runs the shard workers as ``python -m sappservice -c <config> --shard i --shards n`` and
+    restarts any that exit, with backoff.
+    """
+
+    log: logging.Logger
+
+    def __init__(self, config_filename: str, shards: int) -> None:
+        self.log = logging.getLogger("sharding.supervisor")
+        self.config_filename = config_filename
+        self.shards = shards
+        self.processes: Dict[int, asyncio.subprocess.Process] = dict()
+        self.stopping = False
+
+    async def _run_worker(self, shard: int) -> None:
+        backoff = Backoff(first=1, initial=2, maximum=60)
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "sappservice", "-c", self.config_filename,
+                "--shard", str(shard), "--shards", str(self.shards))
+            self.processes[shard] = process
+            self.log.info(f"Started worker {shard} (pid {process.pid})")
+            code = await process.wait()
+            if self.stopping:
+                break
+            delay = backoff.next()
+            self.log.error(f"Worker {shard} exited with {code}, restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def stop(self) -> None:
+        self.stopping = True
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+
+    async def run(self) -> None:
+        await asyncio.gather(*[self._run_worker(shard) for shard in range(self.shards)])
+
+
+async def supervise(config_filename: str, shards: int, loop: asyncio.AbstractEventLoop) -> None:
+    config = Config(config_filename, "", "")
+    config.load()
+
+    logging.config.dictConfig(copy.deepcopy(config["logging"]))
+    log = logging.getLogger("sharding")
+    await upgrade_database(config["appservice.database"])
+    log.info(f"Starting {shards} bridge workers")
+
+    workers = [f"http://127.0.0.1:{worker_port(config, shard)}" for shard in range(shards)]
+    router = TransactionRouter(config["appservice.hs_token"], workers,
+                               max_body_size=int(config["appservice.max_body_size"] or 1) * 1024 ** 2)
+    await router.start(config["appservice.hostname"], config["appservice.port"])
+
+    supervisor = Supervisor(config_filename, shards)
+    for signame in ("SIGINT", "SIGTERM"):
+        loop.add_signal_handler(getattr(signal, signame), supervisor.stop)
+    try:
+        await supervisor.run()
+    finally:
+        await router.stop()
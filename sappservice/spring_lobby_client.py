@@ -21,9 +21,12 @@
 import asyncio
 import logging
 import sys
+import time
 
 import re
 
+from typing import Dict, Optional, Set, Tuple
+
 from asyncblink import signal as asignal
 
 from asyncspring.lobby import LobbyProtocol, LobbyProtocolWrapper, connections
@@ -31,18 +34,36 @@ from mautrix.appservice import AppService
 from mautrix.errors import MNotFound, MUnknown
 from mautrix.types import PresenceState, UserID, RoomID, Member, Membership
 
+from sappservice.connection import BACKOFF, CONNECTING, Backoff, LobbyConnection
+from sappservice.identity import IdentityMapper
+from sappservice.lanes import LaneDispatcher
+from sappservice.lobby_filter import LobbyEventFilter
+from sappservice.membership import MembershipBatcher
+from sappservice.metrics import HANDLER_LATENCY, LOBBY_RECONNECTS
+from sappservice.outbound import OutboundDispatcher
+from sappservice.outbox import LobbyOutbox
+from sappservice.profile_cache import ProfileCache
+from sappservice.puppets import PuppetRegistry
+from sappservice.receipts import ReceiptCoalescer
+from sappservice.reconcile import BridgedSnapshot, Identity
+from sappservice.rooms import BridgedRoom, RoomRegistry
+from sappservice.scheduler import PRIORITY_MEMBERSHIP, PRIORITY_MESSAGE, RequestScheduler
+
 
 class SpringLobbyClient(object):
     log: logging.Logger
     appserv: AppService
 
-    def __init__(self, appserv, config, loop):
+    def __init__(self, appserv, config, loop, db=None):
 
         self.log: logging.Logger = logging.getLogger("lobby")
 
         self.config = config
+        self.settings = config.settings
 
         self.bot = None
+        self.connection = None
+        self.recorder = None
         self.appserv = appserv
         self.presence_timmer = None
         self.bot_username = self.config["spring.bot_username"]
@@ -52,8 +73,48 @@ class SpringLobbyClient(object):
         self.port = self.config["spring.port"]
         self.use_ssl = self.config["spring.ssl"]
         self.client_name = self.config["spring.client_name"]
-        self.rooms = self.config["bridge.rooms"]
+        self.rooms = RoomRegistry(self.config["bridge.rooms"])
+        self.lobby_filter = LobbyEventFilter(self.rooms)
         self.enabled_rooms = list()
+        self.sync_concurrency = self.config["bridge.sync_concurrency"] or 8
+        self.scheduler = RequestScheduler(rate=self.config["bridge.rate_limit.rate"] or 50,
+                                          burst=self.config["bridge.rate_limit.burst"] or 100,
+                                          user_rate=self.config["bridge.rate_limit.user_rate"] or 10,
+                                          user_burst=self.config["bridge.rate_limit.user_burst"] or 20,
+                                          max_retries=self.config.get_or("bridge.rate_limit.max_retries", 5),
+                                          bot_mxid=self.settings.bot_mxid)
+        self.profiles = ProfileCache(appserv,
+                                     max_size=self.config["bridge.profile_cache.size"] or 10000,
+                                     ttl=self.config["bridge.profile_cache.ttl"] or 3600,
+                                     negative_ttl=self.config["bridge.profile_cache.negative_ttl"] or 300,
+                                     scheduler=self.scheduler)
+        self.outbound = OutboundDispatcher(workers=self.config["bridge.outbound.workers"] or 4,
+                                           max_queue_size=self.config["bridge.outbound.max_queue_size"] or 1000,
+                                           overflow=self.config["bridge.outbound.overflow"] or "block")
+        self.receipts = ReceiptCoalescer(appserv, delay=self.config.get_or("bridge.receipt_delay", 1.0),
+                                         scheduler=self.scheduler)
+        self.lanes = LaneDispatcher(concurrency=self.config["bridge.lanes.concurrency"] or 64,
+                                    chat_reserve=self.config.get_or("bridge.lanes.chat_reserve", 16))
+        self.membership = MembershipBatcher(self._apply_membership,
+                                            window=self.config.get_or("bridge.membership.batch_window", 0.5))
+        self.membership_concurrency = self.config["bridge.membership.concurrency"] or 10
+        self.puppets = PuppetRegistry(appserv,
+                                      namespace=self.settings.namespace,
+                                      domain=self.settings.homeserver_domain,
+                                      max_size=self.config["bridge.puppet_cache_size"] or 50000)
+        self.outbox = LobbyOutbox(db, connected=self._lobby_connected,
+                                  max_size=self.config["bridge.lobby_outbox.max_size"] or 10000,
+                                  max_age=self.config["bridge.lobby_outbox.max_age"] or 3600,
+                                  shard=self.config["sharding.shard"] or 0)
+        self.snapshot = BridgedSnapshot(db)
+        self.identities = IdentityMapper(namespace=self.settings.namespace,
+                                         bot_username=self.settings.bot_username,
+                                         prefixes=self.config["bridge.identity.prefixes"],
+                                         ignore=self.config["bridge.identity.ignore"] or (),
+                                         cache_size=self.config["bridge.identity.cache_size"] or 10000)
+        self.lobby_keeps_state = bool(self.config["bridge.reconcile.lobby_keeps_state"])
+        # rooms whose members were fetched from the homeserver since startup
+        self._fetched_rooms: Set[RoomID] = set()
 
         self.loop = loop
 
@@ -66,38 +127,42 @@ class SpringLobbyClient(object):
         use_ssl = self.use_ssl
         client_name = self.client_name
 
-        await self.appserv.intent.set_presence(PresenceState.ONLINE)
+        self.outbound.start()
+        await self.outbox.start()
+        await self.snapshot.load(channels=[room.name for room in self.rooms])
 
         self.bot = await self.connect(server=server,
                                       port=port,
                                       use_ssl=use_ssl,
                                       name=client_name)
+        asignal("connection-lost").connect(self.connection_lost)
 
         self.log.debug("### Channels to join ###")
-        for room_name, room_data in self.rooms.items():
-            if room_data['enabled'] is True:
-                self.log.debug(f"Join {room_name}")
-                self.bot.channels_to_join.append(room_name)
+        for room in self.rooms:
+            if room.enabled:
+                self.log.debug(f"Join {room.channel}")
+                self.bot.channels_to_join.append(room.channel)
             else:
-                self.log.debug(f"Not join {room_name}")
+                self.log.debug(f"Not join {room.channel}")
 
     async def config_rooms(self):
 
         self.log.debug("### CONFIG ROOMS ###")
 
-        for room_name, room_data in self.rooms.items():
-            channel = f"#{room_name}"
-            room_id = room_data["room_id"],
-            room_enabled = room_data["enabled"]
-
-            self.log.info(f"{room_enabled} channel : {channel} room_name : {room_name} room_id : {room_id}")
-            if room_enabled is True:
-                self.bot.channels_to_join.append(channel)
-                await self.appserv.intent.join_room(room_id[0])
-                self.enabled_rooms.append(room_id[0])
-            else:
+        for room in self.rooms:
+            channel = f"#{room.channel}"
+
+            self.log.info(f"{room.enabled} channel : {channel} room_name : {room.channel} room_id : {room.room_id}")
+            if room.enabled:
+                if channel not in self.bot.channels_to_join:
+                    self.bot.channels_to_join.append(channel)
+                # a no-op without a request when the state store knows the bot is joined
+                await self.appserv.intent.ensure_joined(room.room_id)
+                if room.room_id not in self.enabled_rooms:
+                    self.enabled_rooms.append(room.room_id)
+            elif await self.appserv.state_store.is_joined(room.room_id, self.settings.bot_mxid):
                 try:
-                    await self.appserv.intent.leave_room(room_id[0])
+                    await self.appserv.intent.leave_room(room.room_id)
                     self.log.debug("Appservice leaves this room")
                 except MUnknown as mu:
                     self.log.debug("Appservice not in this room")
@@ -114,7 +179,7 @@ class SpringLobbyClient(object):
     async def login_matrix_account(self, user_name):
 
         self.log.debug(f"User {user_name} joined from lobby")
-        domain = self.config['homeserver.domain']
+        domain = self.settings.homeserver_domain
 
         # namespace = self.config['appservice.namespace']
         # matrix_id = f"@{namespace}_{user_name.lower()}:{domain}"
@@ -130,16 +195,16 @@ class SpringLobbyClient(object):
     async def logout_matrix_account(self, user_name):
         self.log.debug(f"User {user_name} leave lobby")
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-        matrix_id = f"@{namespace}_{user_name.lower()}:{domain}"
-        user = self.appserv.intent.user(UserID(matrix_id))
+        domain = self.settings.homeserver_domain
+        user = self.puppets.intent(user_name)
 
         rooms = await user.get_joined_rooms()
 
         for room_id in rooms:
             await user.leave_room(room_id=room_id)
 
+        self.puppets.forget(user_name)
+
         # await user.set_presence("offline")
         # self.presence_timmer.cancel()
         self.bot.un_bridged_client_from(domain, user_name)
@@ -162,182 +227,171 @@ class SpringLobbyClient(object):
     #                 user = self.appserv.intent.user(user=member)
     #                 await user.leave_room(room_id)
 
-    async def sync_matrix_users(self) -> None:
-        self.log.debug("Sync matrix users")
-
-        bot_username = self.config["appservice.bot_username"]
-
-        for room_name, room_data in self.rooms.items():
-            spring_room = room_data.get('name')
-            room_id = RoomID(room_data.get("room_id"))
-            enabled = room_data.get("enabled")
-
-            if enabled:
-                self.log.debug(f"Room {spring_room} enabled")
-                await self.appserv.intent.ensure_joined(room_id=room_id)
-                members = await self.appserv.intent.get_room_members(room_id)
-
-                for mxid in members:
-
-                    self.log.debug(f"member {mxid}")
-
-                    member = await self.appserv.intent.get_room_member_info(room_id=room_id, user_id=mxid)
+    async def _fetch_members(self, room: BridgedRoom,
+                             semaphore: asyncio.Semaphore) -> Optional[Dict[UserID, Member]]:
+        async with semaphore:
+            try:
+                await self.appserv.intent.ensure_joined(room_id=room.room_id)
+                # the intent stores the fetched member list in the state store itself
+                members = await self.appserv.intent.get_joined_members(room.room_id)
+                self._fetched_rooms.add(room.room_id)
+                return members
+            except Exception:
+                self.log.exception(f"Failed to fetch members of {room.name}")
+                return None
+
+    async def warm(self) -> None:
+        """
+        Prepare a standby for taking over without touching the lobby.
 
-                    if mxid.startswith(f"@{bot_username}"):
-                        self.log.debug(f"Ignore myself {mxid}")
+        The room members come from the shared state store, which the leader keeps current, so
+        the sync after a takeover needs no homeserver requests. Rooms the state store knows
+        nothing about are fetched from the homeserver. The profile cache is primed with every
+        member's displayname.
+        """
+        semaphore = asyncio.Semaphore(self.sync_concurrency)
+        started = time.monotonic()
 
-                    elif mxid.startswith(f"@{self.config['appservice.namespace']}_"):
-                        self.log.debug(f"Ignoring local user {mxid}")
-                    else:
-                        self.log.debug(f"Loging user {mxid}")
-                        await self.appserv.state_store.set_member(room_id, mxid, member)
+        async def warm_room(room: BridgedRoom) -> int:
+            members = await self.appserv.state_store.get_joined_member_map(room.room_id)
+            if members:
+                self._fetched_rooms.add(room.room_id)
             else:
-                self.log.debug(f"Room {spring_room} disabled")
+                members = await self._fetch_members(room, semaphore) or {}
+            for mxid, member in members.items():
+                self.profiles.update(mxid, member.displayname)
+            return len(members)
 
-        self.log.debug("Start bridging users")
+        counts = await asyncio.gather(*[warm_room(room) for room in self.rooms.enabled])
+        self.log.info(f"Warmed {sum(counts)} members of {len(counts)} rooms in "
+                      f"{time.monotonic() - started:.3f}s")
 
-        bridged_clients = list()
-        for room_name, room_data in self.rooms.items():
-            enabled = room_data.get("enabled")
-            if enabled:
-                room_id = RoomID(room_data.get("room_id"))
-                room_users = await self.appserv.intent.get_room_members(room_id)
-                for user in room_users:
-                    bridged_clients.append(user)
+    async def sync_matrix_users(self) -> None:
+        """
+        Bridge the matrix users of the enabled rooms to the lobby.
 
-        for member in list(set(bridged_clients)):
-            self.log.debug(f"User {member}")
-            localpart, domain = self.appserv.intent.parse_user_id(member)
+        The first time a room is synced its members are fetched with a single /joined_members
+        request, bounded by ``bridge.sync_concurrency``, and written to the state store. Later
+        syncs, after a lobby reconnect, read them from the state store, which is kept up to date
+        by the homeserver's transactions.
 
-            if localpart == "_discord_bot":
-                continue
+        The members are compared with the persisted snapshot of what was bridged before. When the
+        lobby keeps bridged clients across reconnects (``bridge.reconcile.lobby_keeps_state``) only
+        the difference is sent, otherwise every user is bridged again.
+        """
+        self.log.debug("Sync matrix users")
 
-            try:
-                displayname = await self.appserv.intent.get_displayname(UserID(member))
-            except Exception as nf:
-                self.log.error(f"user {localpart} has no profile {nf}")
-                displayname = localpart
-
-            if localpart.startswith("_discord_"):
-                localpart = localpart.lstrip("_discord_")
-                domain = "discord"
-            elif localpart.startswith("freenode_"):
-                localpart = localpart.lstrip("freenode_")
-                domain = "freenode.org"
-            elif localpart.startswith("spring_"):
-                localpart = localpart.lstrip("spring_")
-                domain = "springlobby"
-
-            if len(displayname) > 15:
-                displayname = displayname[:15]
-            if len(localpart) > 15:
-                localpart = localpart[:15]
-            if len(domain) > 15:
-                domain = domain[:15]
-
-            domain = domain.replace('-', '_')
-
-            self.log.debug(
-                f"Bridging user {member} for {domain} externalID {localpart} externalUsername {displayname}")
-            self.bot.bridged_client_from(domain, localpart.lower(), displayname)
-
-        self.log.debug("Users bridged")
-        self.log.debug("Join matrix users")
-
-        for room_name, room_data in self.rooms.items():
-            enabled = room_data.get("enabled")
-            if enabled:
-                room_id = RoomID(room_data.get("room_id"))
-                room_users = await self.appserv.intent.get_room_members(room_id)
-
-                for member in room_users:
-
-                    self.log.debug(f"\tMember: {member}")
-
-                    localpart, user_domain = self.appserv.intent.parse_user_id(UserID(member))
-
-                    self.log.debug(f"\t\tdetails: {localpart} {user_domain}")
-
-                    if localpart == self.config["appservice.bot_username"]:
-                        self.log.debug(f"Not bridging the local appservice")
-                        continue
-                    elif localpart == "_discord_bot":
-                        self.log.debug(f"Not bridging the discord appservice")
-                        continue
-
-                    if localpart.startswith(self.config["appservice.namespace"]):
-                        self.log.debug(f"Ignoring local user {localpart}")
-                        continue
-                    elif localpart.startswith("_discord_"):
-                        localpart = localpart.lstrip("_discord_")
-                        user_domain = "discord"
-                    elif localpart.startswith("freenode_"):
-                        localpart = localpart.lstrip("freenode_")
-                        user_domain = "freenode.org"
-                    elif localpart.startswith("spring"):
-                        localpart = localpart.lstrip("spring_")
-                        user_domain = "springlobby"
-
-                    try:
-                        displayname = await self.appserv.intent.get_displayname(UserID(member))
-                    except Exception as nf:
-                        self.log.error(f"user {localpart} has no profile {nf}")
-                        displayname = localpart
-
-                    if len(displayname) > 15:
-                        displayname = displayname[:15]
-                    if len(localpart) > 15:
-                        localpart = localpart[:15]
-                    if len(user_domain) > 15:
-                        self.log.debug("user domain too long")
-                        user_domain = user_domain[:15]
-
-                    self.log.debug(f"user_name = {localpart}")
-                    self.log.debug(f"display_name = {displayname}")
-                    self.log.debug(f"domain = {user_domain}")
-
-                    for _, room in self.rooms.items():
-                        if room["room_id"] == room_id:
-                            self.log.debug(f"Join channel {room.get('name')}, user {localpart}, domain {user_domain}")
-                            self.bot.join_from(room["name"], user_domain, localpart)
+        semaphore = asyncio.Semaphore(self.sync_concurrency)
+        started = time.monotonic()
+
+        async def fetch_members(room: BridgedRoom) -> Tuple[BridgedRoom, Optional[Dict[UserID, Member]]]:
+            if room.room_id in self._fetched_rooms:
+                return room, await self.appserv.state_store.get_joined_member_map(room.room_id)
+            return room, await self._fetch_members(room, semaphore)
+
+        desired: Dict[Tuple[UserID, str], Identity] = dict()
+        for fetched in asyncio.as_completed([fetch_members(room) for room in self.rooms.enabled]):
+            room, members = await fetched
+            if members is None:
+                # keep what was bridged before rather than leaving everyone
+                desired.update((key, identity) for key, identity in self.snapshot.entries.items()
+                               if key[1] == room.name)
+                continue
+            self.log.debug("Fetched %d members of %s after %.3fs", len(members), room.name,
+                           time.monotonic() - started)
+
+            for mxid, member in members.items():
+                self.profiles.update(mxid, member.displayname)
+                identity = self.identities.resolve(mxid)
+                if identity is None:
+                    self.log.debug("Not bridging %s", mxid)
+                    continue
+                desired[(mxid, room.name)] = (identity.domain, identity.name,
+                                              self.identities.display_name(member.displayname, identity))
+
+        changed, removed = self.snapshot.diff(desired)
+        to_send = changed if self.lobby_keeps_state else desired
+
+        bridged = set()
+        for (mxid, channel), (domain, localpart, displayname) in to_send.items():
+            if mxid not in bridged:
+                bridged.add(mxid)
+                self.log.debug("Bridging user %s for %s externalID %s externalUsername %s",
+                               mxid, domain, localpart, displayname)
+                self.bot.bridged_client_from(domain, localpart, displayname)
+            self.bot.join_from(channel, domain, localpart)
+
+        if self.lobby_keeps_state:
+            remaining = {mxid for mxid, _ in desired}
+            unbridged = set()
+            for mxid, channel in removed:
+                domain, localpart, _ = self.snapshot.entries[(mxid, channel)]
+                self.bot.leave_from(channel, domain, localpart)
+                if mxid not in remaining and mxid not in unbridged:
+                    unbridged.add(mxid)
+                    self.bot.un_bridged_client_from(domain, localpart)
+
+        await self.snapshot.save(changed, removed)
+
+        self.log.info(f"Synced {len(desired)} memberships of {len(self.rooms.enabled)} rooms in "
+                      f"{time.monotonic() - started:.3f}s: bridged {len(bridged)} users, "
+                      f"{len(changed)} changed and {len(removed)} removed since the last sync")
+        self.log.debug("Profile cache %s", self.profiles.stats())
 
     async def join_matrix_room(self, room, clients):
-        self.log.debug("joining matrix room join from lobby")
-        self.log.debug(room)
+        self.log.debug("joining matrix room %s join from lobby", room)
 
-        room_id = self.rooms[room]["room_id"]
-        for client in clients:
-            if client != "appservice":
-                domain = self.config['homeserver.domain']
-                namespace = self.config['appservice.namespace']
-                matrix_id = f"@{namespace}_{client.lower()}:{domain}"
-                user = self.appserv.intent.user(UserID(matrix_id))
+        if room not in self.rooms:
+            self.log.debug("Channel %s is not bridged", room)
+            return
 
-                await user.join_room_by_id(room_id=room_id)
+        # queued for the next batch, the lanes wait on the returned future where order matters
+        return self.membership.join(room, [client for client in clients if client != "appservice"])
 
     async def leave_matrix_room(self, room, clients):
-        self.log.debug("leaving matrix room left from lobby")
-        self.log.debug(room)
-        for client in clients:
-            self.log.debug(client)
-            if client != "spring":
-                self.log.debug(f"CLIENT {client}")
-
-                domain = self.config['homeserver.domain']
-                namespace = self.config['appservice.namespace']
+        self.log.debug("leaving matrix room %s left from lobby", room)
 
-                matrix_id = f"@{namespace}_{client.lower()}:{domain}"
-                self.log.debug(matrix_id)
-
-                room_id = RoomID(self.rooms[room]["room_id"])
-                self.log.debug(room_id)
+        if room not in self.rooms:
+            self.log.debug("Channel %s is not bridged", room)
+            return
 
-                user = self.appserv.intent.user(user_id=UserID(matrix_id))
+        return self.membership.leave(room, [client for client in clients if client != "spring"])
 
-                self.log.debug(user)
-                await user.leave_room(room_id=room_id)
+    @HANDLER_LATENCY.time("lobby_to_matrix", "membership")
+    async def _apply_membership(self, room, joins, leaves):
+        """
+        Join and leave the puppets of a batch of lobby users, skipping puppets the state store
+        already knows to be joined.
+        """
+        room_id = self.rooms.room_id_for(room)
+
+        joined = None
+        if any(room_id not in self.puppets.get(client).rooms for client in joins):
+            joined = await self.appserv.state_store.get_joined_user_ids(room_id)
+        semaphore = asyncio.Semaphore(self.membership_concurrency)
+
+        async def apply(client, join):
+            puppet = self.puppets.get(client)
+            if join and (room_id in puppet.rooms or puppet.mxid in joined):
+                puppet.rooms.add(room_id)
+                return
+            user = self.puppets.intent(client)
+            async with semaphore:
+                try:
+                    if join:
+                        await self.scheduler.run(user.join_room_by_id, room_id=room_id,
+                                                 key=puppet.mxid, priority=PRIORITY_MEMBERSHIP)
+                        self.puppets.joined(client, room_id)
+                    else:
+                        await self.scheduler.run(user.leave_room, room_id=room_id,
+                                                 key=puppet.mxid, priority=PRIORITY_MEMBERSHIP)
+                        self.puppets.left(client, room_id)
+                except Exception:
+                    self.log.exception(f"Failed to {'join' if join else 'leave'} {puppet.mxid} in {room_id}")
 
-        self.log.debug("succes leaved matrix room left from lobby")
+        await asyncio.gather(*[apply(client, True) for client in joins],
+                             *[apply(client, False) for client in leaves])
+        self.log.debug("Applied %s joins and %s leaves in %s", len(joins), len(leaves), room)
 
     #
     # async def create_matrix_room(self, room):
@@ -353,145 +407,119 @@ class SpringLobbyClient(object):
     #     except Exception as e:
     #         self.log.debug(e)
     #
+    @HANDLER_LATENCY.time("lobby_to_matrix", "said")
     async def said(self, user, room, message):
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-
-        matrix_id = f"@{namespace}_{user.lower()}:{domain}"
-
-        room_id = self.rooms[room]["room_id"]
-
-        user = self.appserv.intent.user(UserID(matrix_id))
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            return
 
-        await user.send_text(room_id, message)
+        await self.scheduler.run(self.puppets.intent(user).send_text, room_id, message,
+                                 key=self.puppets.get(user).mxid, priority=PRIORITY_MESSAGE,
+                                 txn_id=self.scheduler.txn_id())
 
+    @HANDLER_LATENCY.time("lobby_to_matrix", "saidex")
     async def saidex(self, user, room, message):
 
-        domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-
-        matrix_id = f"@{namespace}_{user.lower()}:{domain}"
-
-        room_id = self.rooms[room]["room_id"]
-
-        user = self.appserv.intent.user(UserID(matrix_id))
+        room_id = self.rooms.room_id_for(room)
+        if room_id is None:
+            return
 
-        await user.send_emote(room_id, message)
+        await self.scheduler.run(self.puppets.intent(user).send_emote, room_id, message,
+                                 key=self.puppets.get(user).mxid, priority=PRIORITY_MESSAGE,
+                                 txn_id=self.scheduler.txn_id())
 
+    @HANDLER_LATENCY.time("matrix_to_lobby", "matrix_user_joined")
     async def matrix_user_joined(self, user_id, room_id, event_id=None):
         """
         Matrix user Joins the room
         """
 
-        hs_domain = self.config['homeserver.domain']
-        namespace = self.config['appservice.namespace']
-        bot_username = self.config["appservice.bot_username"]
-
-        if user_id == f"@{bot_username}:{hs_domain}":
-            self.log.debug(f"Appservice joined {room_id}")
-            return
-        elif user_id.startswith(f"@{namespace}_") and user_id.endswith(f":{hs_domain}"):
-            self.log.debug(f"Local user {user_id} joined room_id {room_id} ignoring")
+        identity = self.identities.resolve(user_id)
+        if identity is None:
+            self.log.debug("Not bridging %s joining %s", user_id, room_id)
             return
 
         # obtain the spring room name from config
-        channel = None
-        for room in self.rooms:
-            if self.rooms[room]["room_id"] == room_id:
-                channel = room
-
-        user_domain = self.appserv.intent.user(user_id=user_id).domain
-        user_name = self.appserv.intent.user(user_id=user_id).localpart
-
-        # check is is the our appservice bot
-        if user_name == self.config["appservice.bot_username"] and user_domain == self.config["homeserver.domain"]:
+        room = self.rooms.by_room_id(room_id)
+        if room is None or not room.enabled:
+            self.log.debug("Room %s is not bridged", room_id)
             return
+        channel = room.name
 
-        self.log.debug(f"Matrix user {user_name} joined room {room_id}")
+        self.log.debug("Matrix user %s joined room %s", user_id, room_id)
         if event_id:
-            await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+            self.receipts.mark_read(room_id, event_id)
 
-        if user_name and user_domain:
-            display_name = await self.appserv.intent.get_displayname(user_id=user_id)
+        display_name = self.identities.display_name(await self.profiles.get_displayname(user_id), identity)
 
-            self.bot.bridged_client_from(user_domain, user_name.lower(), display_name)  # TODO check if already bridged
-            self.log.debug(f"Matrix user {user_name} bridged")
+        # TODO check if already bridged
+        await self.outbox.send("bridged_client_from", identity.domain, identity.name, display_name)
+        self.log.debug("Matrix user %s bridged", identity.name)
 
-            self.bot.join_from(channel, user_domain, user_name)
-            self.log.debug(f"Matrix user {user_name} joined {channel}")
+        await self.outbox.send("join_from", channel, identity.domain, identity.name)
+        await self.snapshot.add(user_id, channel, (identity.domain, identity.name, display_name))
+        self.log.debug("Matrix user %s joined %s", identity.name, channel)
 
+    @HANDLER_LATENCY.time("matrix_to_lobby", "matrix_user_left")
     async def matrix_user_left(self, user_id, room_id, event_id):
 
-        spring_room = None
-        for key in self.rooms:
-            if self.rooms[key].get("room_id") == room_id:
-                spring_room = key
+        identity = self.identities.resolve(user_id)
+        if identity is None:
+            return
 
-        display_name = await self.appserv.intent.get_displayname(user_id=user_id)
-        user_domain = self.appserv.intent.user(user_id=user_id).domain
-        user_name = self.appserv.intent.user(user_id=user_id).localpart
+        room = self.rooms.by_room_id(room_id)
+        if room is None or not room.enabled:
+            self.log.debug("Room %s is not bridged", room_id)
+            return
+        spring_room = room.name
 
         if event_id:
-            await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+            self.receipts.mark_read(room_id, event_id)
 
-        self.bot.leave_from(spring_room, user_domain, display_name)
-        self.log.debug(f"Matrix user {user_name} leaves {spring_room}")
+        await self.outbox.send("leave_from", spring_room, identity.domain, identity.name)
+        await self.snapshot.remove(user_id, spring_room)
+        self.log.debug("Matrix user %s leaves %s", identity.name, spring_room)
 
+    @HANDLER_LATENCY.time("matrix_to_lobby", "say_from_matrix")
     async def say_from_matrix(self, user_id, room_id, event_id, body, emote=False):
 
-        namespace = self.config['appservice.namespace']
-        if user_id.startswith(f"@{namespace}"):
+        identity = self.identities.resolve(user_id)
+        if identity is None:
             return
 
-        self.log.debug(f"room ID = {room_id}")
-        self.log.debug(f"user ID = {user_id}")
+        self.log.debug("room ID = %s", room_id)
+        self.log.debug("user ID = %s", user_id)
 
-        room_name = None
-        for k, v in self.rooms.items():
-            if v.get("room_id") == room_id:
-                room_name = k
+        room = self.rooms.by_room_id(room_id)
 
-        if room_name is None:
+        if room is None:
             return
 
-        # room_name = list(v.get('name') for _, v in self.rooms.items() if v.get('room_id') == room_id)[0]
+        channel = room.name
 
-        room_data = self.rooms.get(room_name)
-
-        channel = room_data.get('name')
-        stored_room_id = room_data.get('room_id')
-        enabled = room_data.get('enabled')
-
-        if enabled is False:
-            self.log.debug(f"room id: {stored_room_id} active: {enabled}")
+        if room.enabled is False:
+            self.log.debug("room id: %s active: %s", room.room_id, room.enabled)
             return
 
-        user_name = self.appserv.intent.user(user_id=UserID(user_id)).localpart
-        domain = self.appserv.intent.user(user_id=UserID(user_id)).domain
-
-        self.log.debug(f"User Name = {user_name}")
-
-        if user_name.startswith("_discord"):
-            domain = "discord"
-            user_name = user_name.lstrip("_discord_")
-
-        elif user_name.startswith("freenode_"):
-            domain = "frenode.org"
-            user_name = user_name.lstrip("freenode_")
-
-        if len(user_name) > 15:
-            user_name = user_name[:15]
+        self.log.debug("User Name = %s", identity.name)
 
         # if emote is True:
-        #     self.bot.say_ex(user_name, domain, channel, body)
+        #     self.bot.say_ex(identity.name, identity.domain, channel, body)
         # else:
-        self.bot.say_from(user_name, domain, channel, body)
+        await self.outbox.send("say_from", identity.name, identity.domain, channel, body)
 
-        await self.appserv.intent.mark_read(room_id=room_id, event_id=event_id)
+        self.receipts.mark_read(room_id, event_id)
 
     async def exit(self, signal_name):
         self.log.debug("Singal received exiting")
+        await self.lanes.stop()
+        await self.outbound.stop()
+        await self.receipts.stop()
+        await self.membership.stop()
+        await self.scheduler.stop()
+        if self.recorder is not None:
+            await self.recorder.stop()
         # await self.clean_matrix_rooms()
         # loop.stop()
         sys.exit(0)
@@ -499,29 +527,23 @@ class SpringLobbyClient(object):
     def login(self):
         pass
 
-    async def connect(self, server, port=8200, use_ssl=False, name=None, flags=None):
-        """
-        Connect to an SpringRTS Lobby server. Returns a proxy to an LobbyProtocol object.
-        """
-        protocol = None
-        while protocol is None:
-            try:
-                transport, protocol = await self.loop.create_connection(lambda: LobbyProtocol(self.bot_username,
-                                                                                              self.bot_password,
-                                                                                              self.client_name,
-                                                                                              self.client_flags
-                                                                                              ),
-                                                                        host=server,
-                                                                        port=port,
-                                                                        ssl=use_ssl)
-            except ConnectionRefusedError as conn_error:
-                self.log.info(f"HOST DOWN! retry in 10 secs {conn_error}")
-                await asyncio.sleep(10)
+    def _lobby_connected(self):
+        protocol = getattr(self.bot, "protocol", None)
+        transport = getattr(protocol, "transport", None)
+        return transport is not None and not transport.is_closing()
 
-        self.log.info("connected")
-        protocol.wrapper = LobbyProtocolWrapper(protocol)
-        protocol.server_info = {"host": server, "port": port, "ssl": use_ssl}
-        protocol.netid = f"{id(protocol)}:{server}:{port}{'+' if use_ssl else '-'}"
+    def _protocol_factory(self):
+        protocol = LobbyProtocol(self.bot_username, self.bot_password, self.client_name, self.client_flags)
+        if self.recorder is not None:
+            self.recorder.wrap_protocol(protocol)
+        return protocol
+
+    def _setup_protocol(self, protocol, wrapper, name=None, flags=None):
+        protocol.wrapper = wrapper
+        protocol.server_info = {"host": self.connection.host, "port": self.connection.port,
+                                "ssl": self.connection.use_ssl}
+        protocol.netid = f"{id(protocol)}:{self.connection.host}:{self.connection.port}" \
+                         f"{'+' if self.connection.use_ssl else '-'}"
 
         if name is not None:
             protocol.name = name
@@ -531,24 +553,46 @@ class SpringLobbyClient(object):
 
         asignal("netid-available").send(protocol)
 
-        connections[protocol.netid] = protocol.wrapper
+        connections[protocol.netid] = wrapper
+
+    async def connect(self, server, port=8200, use_ssl=False, name=None, flags=None):
+        """
+        Connect to an SpringRTS Lobby server. Returns a proxy to an LobbyProtocol object.
+        """
+        self.connection = LobbyConnection(self.loop, self._protocol_factory, host=server, port=port,
+                                          use_ssl=use_ssl,
+                                          timeout=self.config["spring.connect_timeout"] or 30,
+                                          backoff=Backoff(first=self.config.get_or("spring.backoff.first", 0.5),
+                                                          initial=self.config["spring.backoff.initial"] or 2,
+                                                          maximum=self.config["spring.backoff.max"] or 300))
+        transport, protocol = await self.connection.open()
+
+        self.log.info("connected")
+        self._setup_protocol(protocol, LobbyProtocolWrapper(protocol), name=name, flags=flags)
 
         return protocol.wrapper
 
-    async def reconnect(self, client_wrapper):
-        protocol = None
-        server_info = client_wrapper.server_info
+    def connection_lost(self, protocol):
+        """
+        Receiver for the connection-lost signal: reconnect unless a reconnect is already running.
+        """
+        if self.bot is None or protocol is not self.bot.protocol:
+            return
+        if self.connection.state in (CONNECTING, BACKOFF):
+            return
+        asyncio.ensure_future(self.reconnect(self.bot))
 
-        self.log.info("reconnecting")
-        while protocol is None:
-            await asyncio.sleep(10)
-            try:
-                transport, protocol = await self.loop.create_connection(LobbyProtocol, **server_info)
-                client_wrapper.protocol = protocol
+    def lobby_accepted(self):
+        self.connection.ready()
 
-                asignal("netid-available").send(protocol)
+    async def reconnect(self, client_wrapper):
+        self.log.info("reconnecting")
+        LOBBY_RECONNECTS.inc()
+        self.connection.lost()
+        self.outbox.disconnected()
 
-                asignal("reconnected").send()
+        transport, protocol = await self.connection.open()
+        client_wrapper.protocol = protocol
+        self._setup_protocol(protocol, client_wrapper, name=self.client_name)
 
-            except ConnectionRefusedError as conn_error:
-                self.log.info(f"HOST DOWN! retry in 10 secs {conn_error}")
+        asignal("reconnected").send()
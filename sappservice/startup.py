@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import logging
+import time
+
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from aiohttp import web
+
+from sappservice.metrics import STARTUP_STAGE_SECONDS
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Stage(object):
+    __slots__ = ("name", "fn", "requires", "state", "started", "duration")
+
+    def __init__(self, name: str, fn: Callable[[], Awaitable[None]], requires: Iterable[str]) -> None:
+        self.name = name
+        self.fn = fn
+        self.requires = tuple(requires)
+        self.state = PENDING
+        self.started: Optional[float] = None
+        self.duration: Optional[float] = None
+
+
+class Startup(object):
+    """
+    Runs the startup stages, each as soon as the stages it requires are done, so independent
+    stages overlap. Records how long every stage took and serves liveness and readiness checks
+    reflecting the progress.
+    """
+
+    log: logging.Logger
+
+    def __init__(self) -> None:
+        self.log = logging.getLogger("startup")
+        self.stages: Dict[str, Stage] = dict()
+        self.started = time.monotonic()
+        self.duration: Optional[float] = None
+        self._done: Dict[str, asyncio.Future] = dict()
+
+    def add(self, name: str, fn: Callable[[], Awaitable[None]], requires: Iterable[str] = ()) -> None:
+        self.stages[name] = Stage(name, fn, requires)
+
+    @property
+    def ready(self) -> bool:
+        return all(stage.state == DONE for stage in self.stages.values())
+
+    async def _run_stage(self, stage: Stage) -> None:
+        await asyncio.gather(*[self._done[name] for name in stage.requires])
+
+        stage.state = RUNNING
+        stage.started = time.monotonic()
+        self.log.debug("Starting %s", stage.name)
+        try:
+            await stage.fn()
+        except Exception:
+            stage.state = FAILED
+            raise
+        finally:
+            stage.duration = time.monotonic() - stage.started
+            STARTUP_STAGE_SECONDS.set(stage.duration, stage.name)
+
+        stage.state = DONE
+        self.log.info(f"Startup stage {stage.name} done in {stage.duration:.3f}s "
+                      f"({stage.started + stage.duration - self.started:.3f}s since start)")
+
+    async def run(self) -> None:
+        for name, stage in self.stages.items():
+            for required in stage.requires:
+                if required not in self.stages:
+                    raise ValueError(f"Stage {name} requires unknown stage {required}")
+
+        tasks = list()
+        for name, stage in self.stages.items():
+            task = asyncio.ensure_future(self._run_stage(stage))
+            self._done[name] = task
+            tasks.append(task)
+
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        self.duration = time.monotonic() - self.started
+        self.log.info(f"Startup complete in {self.duration:.3f}s")
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready,
+            "stages": {name: {"state": stage.state, "duration": stage.duration}
+                       for name, stage in self.stages.items()},
+        }
+
+    async def handle_live(self, _: web.Request) -> web.Response:
+        failed = any(stage.state == FAILED for stage in self.stages.values())
+        return web.Response(status=500 if failed else 200, text=json.dumps(self.status()),
+                            content_type="application/json")
+
+    async def handle_ready(self, _: web.Request) -> web.Response:
+        return web.Response(status=200 if self.ready else 503, text=json.dumps(self.status()),
+                            content_type="application/json")
+
+    def register_routes(self, app: web.Application, prefix: str = "/health") -> None:
+        app.router.add_get(f"{prefix}/live", self.handle_live)
+        app.router.add_get(f"{prefix}/ready", self.handle_ready)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Dict, Set
+
+from mautrix.appservice.state_store.asyncpg import PgASStateStore
+from mautrix.types import Member, Membership, RoomID, UserID
+
+
+class BridgeStateStore(PgASStateStore):
+    """
+    PgASStateStore with the bulk member reads used by the startup sync and the lobby
+    membership batches.
+    """
+
+    async def get_joined_user_ids(self, room_id: RoomID) -> Set[UserID]:
+        q = "SELECT user_id FROM mx_user_profile WHERE room_id=$1 AND membership='join'"
+        return {UserID(row["user_id"]) for row in await self.db.fetch(q, room_id)}
+
+    async def get_joined_member_map(self, room_id: RoomID) -> Dict[UserID, Member]:
+        """
+        The joined members of a room as known locally, in the shape of
+        ``IntentAPI.get_joined_members``.
+        """
+        q = ("SELECT user_id, displayname, avatar_url FROM mx_user_profile "
+             "WHERE room_id=$1 AND membership='join'")
+        return {UserID(row["user_id"]): Member(membership=Membership.JOIN, displayname=row["displayname"],
+                                               avatar_url=row["avatar_url"])
+                for row in await self.db.fetch(q, room_id)}
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import logging.handlers
+import queue
+import time
+
+from typing import Dict, List, Tuple
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Per-logger rate limit for log records at or below ``max_level``.
+
+    Every logger gets a token bucket of ``burst`` records refilled at ``rate`` records per
+    second. Records over the limit are dropped and counted, and the count is stored in the
+    ``suppressed`` attribute of the next record of that logger that gets through, where
+    :class:`SamplingFormatter` shows it. Usable from the logging dictConfig::
+
+        formatters:
+            sampled:
+                class: sappservice.util.log.SamplingFormatter
+                format: "[%(asctime)s] [%(levelname)s@%(name)s] %(message)s"
+        filters:
+            sampled:
+                (): sappservice.util.log.SamplingFilter
+                rate: 50
+                burst: 200
+    """
+
+    def __init__(self, rate: float = 50, burst: float = 200, max_level: str = "DEBUG") -> None:
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+
+        self._buckets: Dict[str, Tuple[float, float]] = dict()
+        self.dropped: Dict[str, int] = dict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+
+        now = time.monotonic()
+        tokens, last = self._buckets.get(record.name, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[record.name] = (tokens, now)
+            self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+            return False
+
+        self._buckets[record.name] = (tokens - 1, now)
+        dropped = self.dropped.pop(record.name, 0)
+        if dropped:
+            # the record is shared with the other handlers, so its message is left alone
+            record.suppressed = dropped
+        return True
+
+
+class SamplingFormatter(logging.Formatter):
+    """
+    Formatter appending how many records a :class:`SamplingFilter` suppressed before this one.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} [{suppressed} messages suppressed]" if suppressed else text
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. The stock ``prepare`` formats
+    the record on the thread that logged it, which here is the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_queue_logging() -> List[logging.handlers.QueueListener]:
+    """
+    Move the handlers of every configured logger behind a queue, so formatting and file I/O
+    happen on a listener thread instead of the event loop. Records are formatted when the
+    listener gets to them, so log arguments should not be mutated after logging.
+
+    Returns the started listeners, which should be stopped on shutdown to flush the queues.
+    """
+    loggers = [logging.getLogger()]
+    loggers += [logger for logger in logging.Logger.manager.loggerDict.values()
+                if isinstance(logger, logging.Logger)]
+
+    listeners = list()
+    for logger in loggers:
+        if not logger.handlers:
+            continue
+        handlers = list(logger.handlers)
+        records: queue.Queue = queue.Queue(-1)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(_DeferredQueueHandler(records))
+
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        listeners.append(listener)
+    return listeners
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+
+from sappservice.lanes import LANE_CHAT, LANE_MEMBERSHIP, LaneDispatcher
+from sappservice.membership import MembershipBatcher
+
+
+class FakeBridge(object):
+    """
+    The lobby -> matrix side of the bridge, recording the matrix calls it would make.
+    """
+
+    def __init__(self) -> None:
+        self.calls = list()
+        self.membership = MembershipBatcher(self.apply_membership, window=0.05)
+
+    async def apply_membership(self, channel, joins, leaves):
+        await asyncio.sleep(0.01)
+        self.calls += [("join", channel, user) for user in joins]
+        self.calls += [("leave", channel, user) for user in leaves]
+
+    async def join(self, channel, users):
+        return self.membership.join(channel, users)
+
+    async def leave(self, channel, users):
+        return self.membership.leave(channel, users)
+
+    async def said(self, channel, user, text):
+        self.calls.append(("said", channel, user))
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def relay(events):
+    bridge = FakeBridge()
+    lanes = LaneDispatcher(concurrency=4, chat_reserve=1)
+    for lane, user, fn, args in events:
+        lanes.submit(lane, "main", [user], getattr(bridge, fn), "main", *args)
+    await asyncio.sleep(0.2)
+    await lanes.stop()
+    await bridge.membership.stop()
+    return bridge.calls
+
+
+def test_join_then_leave_makes_no_matrix_calls():
+    calls = run(relay([(LANE_MEMBERSHIP, "user", "join", (["user"],)),
+                       (LANE_MEMBERSHIP, "user", "leave", (["user"],))]))
+    assert calls == []
+
+
+def test_chat_waits_for_the_join_of_the_same_user():
+    calls = run(relay([(LANE_MEMBERSHIP, "user", "join", (["user"],)),
+                       (LANE_CHAT, "user", "said", ("user", "hi")),
+                       (LANE_CHAT, "other", "said", ("other", "hi"))]))
+    assert calls == [("said", "main", "other"), ("join", "main", "user"), ("said", "main", "user")]
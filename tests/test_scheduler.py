@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+#   Copyright (c) 2020 TurBoss
+#         <turboss@mail.com>
+#
+#   This file is part of Matrix Spring Appservice.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+
+from multidict import CIMultiDict
+from yarl import URL
+
+from mautrix.api import HTTPAPI, Method
+from mautrix.errors import MatrixConnectionError
+
+from sappservice import scheduler
+from sappservice.connection import Backoff
+
+
+class FakeResponse(object):
+    status = 200
+
+    async def json(self):
+        return {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+
+class FakeSession(object):
+    """
+    Client session whose first ``failures`` requests fail to connect.
+    """
+
+    def __init__(self, failures: int) -> None:
+        self.failures = failures
+        self.requests = 0
+
+    def request(self, *args, **kwargs):
+        self.requests += 1
+        if self.requests <= self.failures:
+            raise aiohttp.ClientConnectionError("connection refused")
+        return FakeResponse()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(scheduler, "Backoff", lambda **_: Backoff(first=0, initial=0, maximum=0))
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def request(failures: int, max_retries: int = 5):
+    session = FakeSession(failures)
+    api = HTTPAPI("http://homeserver", client_session=session, default_retry_count=0)
+    requests = scheduler.RequestScheduler(max_retries=max_retries)
+    try:
+        return await requests.run(api.request, Method.GET, "/_matrix/client/r0/test"), session.requests
+    finally:
+        await requests.stop()
+
+
+def test_connection_error_is_retried():
+    assert run(request(failures=2)) == ({}, 3)
+
+
+def test_connection_error_gives_up_after_max_retries():
+    with pytest.raises(MatrixConnectionError):
+        run(request(failures=10, max_retries=2))
+
+
+class FakeRateLimitResponse(object):
+    status = 429
+
+    async def json(self):
+        return {"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 2000}
+
+
+async def rate_limited(user_id: str):
+    requests = scheduler.RequestScheduler(bot_mxid="@bot:example.com")
+    on_request_end = requests.trace_config().on_request_end[0]
+    url = URL("http://homeserver/_matrix/client/r0/rooms/!room:example.com/send").with_query(user_id=user_id)
+    params = aiohttp.TraceRequestEndParams("PUT", url, CIMultiDict(), FakeRateLimitResponse())
+    await on_request_end(None, SimpleNamespace(), params)
+    return requests
+
+
+def test_rate_limited_bot_request_pauses_bot_bucket():
+    requests = run(rate_limited("@bot:example.com"))
+    assert requests._bucket(None).take() > 1.5
+    assert "@bot:example.com" not in requests._users
+
+
+def test_rate_limited_puppet_request_pauses_puppet_bucket():
+    requests = run(rate_limited("@example_user:example.com"))
+    assert requests._bucket("@example_user:example.com").take() > 1.5
+    assert requests._bucket(None).take() == 0